@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+import time
+
+
+class AccountState:
+    def __init__(self, account_id):
+        """ Last known state of one account
+        Attributes:
+            account_id (String): account on the node
+            address (String): account_pkey, None until looked up
+            balance, available (int): balance in uSTG, None until known
+            sealed (bool): None until known
+            epoch (int): node epoch of the last balance update
+            updated (float): time.monotonic() of the last balance update
+            valid (bool): balance is kept up to date by notifications
+        """
+        self.account_id = account_id
+        self.address = None
+        self.balance = None
+        self.available = None
+        self.sealed = None
+        self.epoch = None
+        self.updated = None
+        self.valid = False
+
+    def fresh(self, max_age=None):
+        if not self.valid:
+            return False
+        return max_age is None or time.monotonic() - self.updated <= max_age
+
+
+class AccountCache:
+    def __init__(self):
+        """ Per-account state, fed by balance_changed notifications and by
+        responses to balance/unseal/account_info requests.
+        """
+        self.accounts = {}
+
+    def __getitem__(self, account_id):
+        state = self.accounts.get(account_id)
+        if state is None:
+            state = self.accounts[account_id] = AccountState(account_id)
+        return state
+
+    def update_balance(self, account_id, msg, epoch=None):
+        state = self[account_id]
+        state.balance = msg.available if msg.balance is None else msg.balance
+        state.available = msg.available
+        state.epoch = epoch
+        state.updated = time.monotonic()
+        state.valid = True
+        # Balance is only reported for unsealed accounts
+        state.sealed = False
+        return state
+
+    def set_sealed(self, account_id, sealed):
+        state = self[account_id]
+        state.sealed = sealed
+        if sealed:
+            state.valid = False
+
+    def set_address(self, account_id, address):
+        self[account_id].address = address
+
+    def invalidate(self):
+        """ Notifications may have been missed (e.g. connection loss) """
+        for state in self.accounts.values():
+            state.valid = False
+
+    def available(self, account_id, max_age=None):
+        """ Cached available balance, None if not known to be fresh """
+        state = self.accounts.get(account_id)
+        if state is None or not state.fresh(max_age):
+            return None
+        return state.available
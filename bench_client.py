@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import messages
+import os
+import platform
+import stegos
+import sys
+import time
+import tracemalloc
+import websockets
+
+from mocknode import MockNode, API_TOKEN
+
+HOST = '127.0.0.1'
+PORT = 3245
+
+
+def status_frame(codec, size=0):
+    msg = {"type": "status_changed", "is_synchronized": True, "epoch": 1, "offset": 0,
+           "padding": "x" * size}
+    return codec.encode(stegos.json_dumps(msg))
+
+
+async def bench_frames(seconds, size):
+    """ Frames/sec through recv_msg (server floods) and send_msg (server drains) """
+    codec = stegos.codec_for(base64.b64decode(API_TOKEN))
+    frame = status_frame(codec, size)
+    results = {}
+
+    async def flood(websocket, path=None):
+        try:
+            while True:
+                for _ in range(0, 100):
+                    await websocket.send(frame)
+                await asyncio.sleep(0)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def drain(websocket, path=None):
+        try:
+            async for _frame in websocket:
+                pass
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    server = await websockets.serve(flood, HOST, PORT, max_size=None)
+    client = stegos.StegosClient(uri=f"ws://{HOST}:{PORT}", api_key=API_TOKEN, debug=False)
+    client.websocket = await websockets.connect(client.uri, max_size=None, max_queue=128)
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        await client.recv_msg()
+        count += 1
+    results['recv_frames_per_sec'] = count / (time.perf_counter() - start)
+    await client.websocket.close()
+    server.close()
+    await server.wait_closed()
+
+    server = await websockets.serve(drain, HOST, PORT, max_size=None)
+    client.websocket = await websockets.connect(client.uri, max_size=None)
+    msg = {"type": "status_info", "id": 1, "padding": "x" * size}
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        for _ in range(0, 100):
+            await client.send_msg(msg)
+        count += 100
+    results['send_frames_per_sec'] = count / (time.perf_counter() - start)
+    await client.websocket.close()
+    server.close()
+    await server.wait_closed()
+    return results
+
+
+def bench_codec(seconds, sizes):
+    """ Microseconds per encrypt/decrypt by payload size """
+    codec = stegos.codec_for(base64.b64decode(API_TOKEN))
+    results = {}
+    for size in sizes:
+        plaintext = os.urandom(size)
+        ciphertext = codec.encrypt(plaintext)
+        row = {}
+        for op, fn, arg in [('encrypt', codec.encrypt, plaintext), ('decrypt', codec.decrypt, ciphertext)]:
+            count = 0
+            start = time.perf_counter()
+            while time.perf_counter() - start < seconds:
+                for _ in range(0, 100):
+                    fn(arg)
+                count += 100
+            row[f"{op}_us"] = (time.perf_counter() - start) / count * 1e6
+        results[str(size)] = row
+    return results
+
+
+async def bench_payments(seconds, concurrency, block_interval):
+    """ Confirmed payments/sec with `concurrency` accounts paying in a loop """
+    node = MockNode(accounts=concurrency, block_interval=block_interval)
+    server = await node.serve(HOST, PORT)
+    config = node.config(f"ws://{HOST}:{PORT}")
+    client = stegos.StegosClient(uri=config['uri'], accounts=config['accounts'],
+                                 api_key=config['api_token'], debug=False)
+    await client.connect()
+    await client.subscribe_status()
+    await client.wait_sync()
+
+    ids = sorted(config['accounts'].keys())
+    deadline = time.perf_counter() + seconds
+    latencies = []
+
+    async def loop(account_id):
+        dest = config['accounts'][ids[0]]
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            result = await client.payment_with_confirmation(account_id, dest, 0.001)
+            if result['success']:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[loop(account_id) for account_id in ids])
+    elapsed = time.perf_counter() - start
+    await client.close()
+    node.stop()
+    server.close()
+    await server.wait_closed()
+    latencies.sort()
+    return {
+        "payments_per_sec": len(latencies) / elapsed,
+        "p50_latency": latencies[len(latencies) // 2] if latencies else None,
+        "p99_latency": latencies[int(len(latencies) * 0.99)] if latencies else None,
+    }
+
+
+async def bench_memory(connections):
+    """ Bytes of Python heap per connected and subscribed StegosClient
+    The mock node runs in the same process, so its side of every
+    connection is included: treat the number as an upper bound.
+    """
+    node = MockNode(block_interval=3600)
+    server = await node.serve(HOST, PORT)
+    config = node.config(f"ws://{HOST}:{PORT}")
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    clients = []
+    for _ in range(0, connections):
+        client = stegos.StegosClient(uri=config['uri'], api_key=config['api_token'], debug=False)
+        await client.connect()
+        await client.subscribe_status()
+        clients.append(client)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    used = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    for client in clients:
+        await client.close()
+    node.stop()
+    server.close()
+    await server.wait_closed()
+    return {"connections": connections, "bytes_per_connection": used / connections}
+
+
+def bench_fanout(seconds, listener_counts):
+    """ Microseconds to dispatch one notification to N listeners """
+    client = stegos.StegosClient(api_key=API_TOKEN, debug=False)
+    msg = messages.parse({"type": "status_changed", "is_synchronized": True, "epoch": 1, "offset": 0})
+    results = {}
+    for listeners in listener_counts:
+        client.listeners.clear()
+        for _ in range(0, listeners):
+            client.add_listener(lambda m: None, ['status_changed'])
+        count = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < seconds:
+            for _ in range(0, 100):
+                client.dispatch(msg)
+            count += 100
+        results[str(listeners)] = (time.perf_counter() - start) / count * 1e6
+    return results
+
+
+async def run(args):
+    results = {
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "json": stegos.json_loads.__module__,
+        "frames": {},
+        "codec_us": bench_codec(args.seconds, args.sizes),
+        "payments": {},
+        "memory": await bench_memory(args.connections),
+        "fanout_us": bench_fanout(args.seconds, args.listeners),
+    }
+    for size in args.sizes:
+        results["frames"][str(size)] = await bench_frames(args.seconds, size)
+    for concurrency in args.concurrency:
+        results["payments"][str(concurrency)] = await bench_payments(
+            args.payment_seconds, concurrency, args.block_interval)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="StegosClient benchmarks against an in-process mock node")
+    parser.add_argument('--output', default=None, help="write JSON results here instead of stdout")
+    parser.add_argument('--seconds', type=float, default=1.0, help="time per micro benchmark")
+    parser.add_argument('--payment-seconds', type=float, default=5.0, help="time per payment benchmark")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64, 1024, 16384], help="payload sizes")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 10, 100, 1000],
+                        help="concurrent paying accounts")
+    parser.add_argument('--block-interval', type=float, default=0.05, help="mock micro block interval")
+    parser.add_argument('--connections', type=int, default=100, help="connections for memory benchmark")
+    parser.add_argument('--listeners', type=int, nargs='+', default=[1, 10, 100], help="listeners for fan-out")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    loop = asyncio.get_event_loop()
+    results = loop.run_until_complete(run(args))
+    encoded = json.dumps(results, indent=2)
+    if args.output is None:
+        print(encoded)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(encoded)
+        print(f"Results written to {args.output}", file=sys.stderr)
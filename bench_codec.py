@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+import argparse
+import base64
+import binascii
+import json
+import stegos
+import time
+
+from Crypto.Cipher import AES
+from Crypto.Util import Counter
+from Crypto import Random
+
+API_KEY = base64.b64decode("NE8L/DhwVJ+dRnN1277vhQ==")
+
+
+def legacy_send(key, msg):
+    """ Outgoing path as it was before stegos.Codec """
+    plaintext = json.dumps(msg).encode()
+    iv = Random.new().read(AES.block_size)
+    iv_int = int(binascii.hexlify(iv), 16)
+    ctr = Counter.new(AES.block_size * 8, initial_value=iv_int)
+    aes = AES.new(key, AES.MODE_CTR, counter=ctr)
+    return str(base64.standard_b64encode(iv + aes.encrypt(plaintext)), "utf-8")
+
+
+def legacy_recv(key, frame):
+    """ Incoming path as it was before stegos.Codec """
+    ciphertext = base64.b64decode(frame)
+    iv_int = int(binascii.hexlify(ciphertext[:16]), 16)
+    ctr = Counter.new(AES.block_size * 8, initial_value=iv_int)
+    aes = AES.new(key, AES.MODE_CTR, counter=ctr)
+    return json.loads(aes.decrypt(ciphertext[16:]))
+
+
+def codec_send(codec, msg):
+    return codec.encode(json.dumps(msg).encode())
+
+
+def codec_recv(codec, frame):
+    return json.loads(codec.decode(frame))
+
+
+def sample_message(size):
+    return {
+        "type": "transaction_status",
+        "tx_hash": "a" * 64,
+        "status": "prepared",
+        "padding": "x" * size,
+    }
+
+
+def rate(fn, arg, msg, seconds):
+    count = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while True:
+        for _ in range(100):
+            fn(arg, msg)
+        count += 100
+        now = time.perf_counter()
+        if now >= deadline:
+            return count / (now - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Messages/sec through WebSocket framing, before and after stegos.Codec")
+    parser.add_argument('--seconds', type=float, default=1.0,
+                        help="time to spend on each measurement")
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[64, 512, 4096, 65536], help="payload sizes in bytes")
+    args = parser.parse_args()
+
+    codec = stegos.codec_for(API_KEY)
+    print(f"{'size':>8} {'path':>5} {'legacy msg/s':>14} {'codec msg/s':>14} {'speedup':>8}")
+    for size in args.sizes:
+        msg = sample_message(size)
+        frame = codec_send(codec, msg)
+        assert legacy_recv(API_KEY, frame) == msg
+        assert codec_recv(codec, legacy_send(API_KEY, msg)) == msg
+
+        for path, legacy, new, legacy_arg, new_arg in [
+                ('send', legacy_send, codec_send, msg, msg),
+                ('recv', legacy_recv, codec_recv, frame, frame)]:
+            before = rate(legacy, API_KEY, legacy_arg, args.seconds)
+            after = rate(new, codec, new_arg, args.seconds)
+            print(f"{size:>8} {path:>5} {before:>14.0f} {after:>14.0f} {after / before:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+import gzip
+import struct
+import time
+
+MAGIC = b'STGSCAP1'
+# Record header: seconds since capture start, direction, payload length
+HEADER = struct.Struct('<dBI')
+INBOUND = 0
+OUTBOUND = 1
+
+
+def open_capture(path, mode):
+    """ Capture files ending with .gz are gzip compressed """
+    if path.endswith('.gz'):
+        return gzip.open(path, mode, compresslevel=1)
+    return open(path, mode, buffering=1024 * 1024)
+
+
+class SessionCapture:
+    def __init__(self, path):
+        """ Decrypted frames of one StegosClient connection, set it as
+        client.capture to record everything send_msg/recv_msg see.
+        Attributes:
+            path (String): capture file, '.gz' suffix for gzip
+            start (float): time.monotonic() at start, record times are relative to it
+        """
+        self.path = path
+        self.file = open_capture(path, 'wb')
+        self.file.write(MAGIC)
+        self.start = time.monotonic()
+        self.count = 0
+
+    def write(self, direction, data):
+        self.file.write(HEADER.pack(time.monotonic() - self.start, direction, len(data)))
+        self.file.write(data)
+        self.count += 1
+
+    def inbound(self, data):
+        self.write(INBOUND, data)
+
+    def outbound(self, data):
+        self.write(OUTBOUND, data)
+
+    def close(self):
+        self.file.close()
+
+
+def read_capture(path):
+    """ Yield (seconds, direction, data) records of a capture file """
+    with open_capture(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a session capture")
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            t, direction, size = HEADER.unpack(header)
+            yield t, direction, f.read(size)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import logging
+import sqlite3
+import sys
+
+from pool import StegosPool
+
+# Max validate_certificate requests in flight
+CONCURRENCY = 64
+# Final results kept in memory
+CACHE_SIZE = 100_000
+
+FIELDS = ('utxo', 'spender', 'recipient', 'rvalue')
+
+
+def certificate_key(cert):
+    return '/'.join(cert[f] for f in FIELDS)
+
+
+def certificate_from_payment(result, spender):
+    """ Certificate of a payment_with_confirmation(use_certificate=True) result
+    spender: address of the paying account
+    """
+    tx = result['tx']
+    return {'utxo': tx['utxo'], 'spender': spender, 'recipient': tx['recipient'], 'rvalue': tx['rvalue']}
+
+
+def read_certificates(path):
+    """ Certificates from a file with one JSON object per line """
+    f = sys.stdin if path == '-' else open(path, 'r')
+    try:
+        for line in f:
+            if line.strip():
+                cert = json.loads(line)
+                yield {field: cert[field] for field in FIELDS}
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+class CertificateCache:
+    def __init__(self, path=None, size=CACHE_SIZE):
+        """ Results of certificates which can't change anymore (is_final)
+        Attributes:
+            path (String): SQLite file keeping results between runs, None for memory only
+            size (int): max results kept in memory (least recently used are evicted)
+        """
+        self.size = size
+        self.results = collections.OrderedDict()
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path)
+            self.db.execute("CREATE TABLE IF NOT EXISTS certificates (key TEXT PRIMARY KEY, result TEXT NOT NULL)")
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def get(self, cert):
+        key = certificate_key(cert)
+        result = self.results.get(key)
+        if result is not None:
+            self.results.move_to_end(key)
+        elif self.db is not None:
+            row = self.db.execute("SELECT result FROM certificates WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                result = json.loads(row[0])
+                self.remember(key, result)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def put(self, cert, result):
+        if not (result['success'] and result.get('is_final')):
+            return
+        key = certificate_key(cert)
+        self.remember(key, result)
+        if self.db is not None:
+            with self.db:
+                self.db.execute("INSERT OR REPLACE INTO certificates (key, result) VALUES (?, ?)",
+                                (key, json.dumps(result)))
+
+    def remember(self, key, result):
+        self.results[key] = result
+        self.results.move_to_end(key)
+        while len(self.results) > self.size:
+            self.results.popitem(last=False)
+
+
+async def validate(pool, node_id, cert):
+    try:
+        async with pool.lease(node_id) as client:
+            result = await client.validate_certificate(cert['utxo'], cert['spender'], cert['recipient'], cert['rvalue'])
+    except Exception as e:
+        result = {'success': False, 'message': str(e)}
+    return result or {'success': False, 'message': "Not connected"}
+
+
+async def validate_all(pool, certificates, cache=None, concurrency=CONCURRENCY):
+    """ Validate certificates over all nodes of the pool, `concurrency` at a time
+    certificates: iterable of dicts with utxo/spender/recipient/rvalue, may be endless
+    Async generator, yields (certificate, result) in completion order. Cached
+    results are yielded without asking a node, final ones are cached. Any
+    node can validate a certificate, each goes to a node picked by health
+    (see health.py), so slow or unsynchronized nodes get few or none.
+    """
+    certificates = iter(certificates)
+    in_flight = {}
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(in_flight) < concurrency:
+                try:
+                    cert = next(certificates)
+                except StopIteration:
+                    exhausted = True
+                    break
+                result = None if cache is None else cache.get(cert)
+                if result is not None:
+                    yield cert, result
+                    continue
+                in_flight[asyncio.ensure_future(validate(pool, pool.pick(), cert))] = cert
+            if not in_flight:
+                return
+            done, _pending = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                cert = in_flight.pop(task)
+                result = task.result()
+                if cache is not None:
+                    cache.put(cert, result)
+                yield cert, result
+    finally:
+        for task in in_flight:
+            task.cancel()
+
+
+async def run(args):
+    pool = StegosPool.from_file(args.nodes, max_connections=args.connections)
+    cache = CertificateCache(args.cache)
+    await pool.start()
+    valid = invalid = 0
+    try:
+        certificates = itertools.chain(*[read_certificates(path) for path in args.files])
+        async for cert, result in validate_all(pool, certificates, cache, args.concurrency):
+            print(json.dumps(dict(cert, **result)), flush=True)
+            if result['success']:
+                valid += 1
+            else:
+                invalid += 1
+    finally:
+        await pool.close()
+        cache.close()
+    logging.info(f"Valid: {valid}, invalid: {invalid}, cached: {cache.hits}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Validate payment certificates in bulk, one JSON result per line")
+    parser.add_argument('files', nargs='+', help="certificate files, one JSON object per line ('-' for stdin)")
+    parser.add_argument('--nodes', default='sample.json', help="nodes file in sample.json format")
+    parser.add_argument('--cache', default='certificates.sqlite', help="cache of final results")
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY, help="max requests in flight")
+    parser.add_argument('--connections', type=int, default=2, help="connections per node")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run(args))
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+import asyncio
+import collections
+
+CHAIN_TYPES = ['micro_block_prepared', 'macro_block_committed', 'micro_block_reverted']
+
+# Default max blocks queued for a slow consumer
+QUEUE_SIZE = 1024
+
+# What a stream does when its queue is full
+BLOCK = 'block'
+DROP_OLDEST = 'drop-oldest'
+ERROR = 'error'
+OVERFLOW_POLICIES = [BLOCK, DROP_OLDEST, ERROR]
+
+# Macro block of an epoch comes after all its micro blocks
+MACRO_OFFSET = float('inf')
+
+
+class ChainOverflow(Exception):
+    pass
+
+
+def block_position(msg):
+    """ (epoch, offset) of a chain notification, offset is None for macro blocks """
+    header = msg.get('header', msg)
+    return header.get('epoch'), header.get('offset')
+
+
+def block_key(msg):
+    epoch, offset = block_position(msg)
+    return epoch, MACRO_OFFSET if offset is None else offset
+
+
+def next_position(msg):
+    """ (epoch, offset) to subscribe from to get the blocks after msg """
+    epoch, offset = block_position(msg)
+    if msg['type'] == 'macro_block_committed':
+        return epoch + 1, 0
+    elif msg['type'] == 'micro_block_prepared':
+        return epoch, offset + 1
+    return epoch, offset
+
+
+class ChainStream:
+    def __init__(self, client, epoch=None, offset=0, maxsize=QUEUE_SIZE, overflow=BLOCK):
+        """ Async iterator over chain notifications of a StegosClient:
+            async for block in client.chain(epoch=...):
+        Attributes:
+            client (StegosClient): connection, subscribed on first iteration
+            epoch, offset: where to start, None epoch for the current one
+            maxsize (int): max blocks queued for a slow consumer
+            overflow: policy when the queue is full
+                BLOCK - stop reading the connection until the consumer catches
+                        up (responses to other requests on it wait too)
+                DROP_OLDEST - discard the oldest queued block, counted in `dropped`
+                ERROR - stop queueing, raise ChainOverflow once the queue is drained
+            position: (epoch, offset) to resume from after the last consumed block
+        Reverted micro blocks still in the queue are removed, micro_block_reverted
+        is delivered only if the consumer already got some of them. Blocks
+        repeated by the node after a reconnect are skipped.
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy '{overflow}', expected one of {', '.join(OVERFLOW_POLICIES)}")
+        self.client = client
+        self.start_position = (epoch, offset)
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.queue = collections.deque()
+        self.waiter = None
+        self.position = None
+        self.expected = None
+        self.dropped = 0
+        self.overflowed = False
+        self.started = False
+        self.closed = False
+
+    async def start(self):
+        self.started = True
+        self.client.chain_streams.add(self)
+        self.client.add_listener(self.on_block, CHAIN_TYPES)
+        await self.client.subscribe_chain(*self.start_position)
+        if self.position is None:
+            self.position = self.client.chain_position
+        if self.expected is None:
+            self.expected = self.client.chain_position
+
+    def close(self):
+        self.closed = True
+        self.client.remove_listener(self.on_block)
+        self.client.resume(self)
+        if self in self.client.chain_streams:
+            self.client.chain_streams.discard(self)
+            if not self.client.chain_streams:
+                self.client.stop_chain()
+        self.wake()
+
+    def __aiter__(self):
+        return self
+
+    async def __aenter__(self):
+        if not self.started:
+            await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    async def __anext__(self):
+        if not self.started:
+            await self.start()
+        while not self.queue:
+            if self.overflowed:
+                raise ChainOverflow(f"{self.client.node_id}: more than {self.maxsize} blocks queued")
+            if self.closed:
+                raise StopAsyncIteration
+            self.waiter = asyncio.get_event_loop().create_future()
+            # Failed together with requests if the connection is lost for good
+            self.client.waiters.add(self.waiter)
+            try:
+                await self.waiter
+            finally:
+                self.client.waiters.discard(self.waiter)
+                self.waiter = None
+        msg = self.queue.popleft()
+        if self.overflow == BLOCK and len(self.queue) <= self.maxsize // 2:
+            self.client.resume(self)
+        self.position = next_position(msg)
+        return msg
+
+    def wake(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def on_block(self, msg):
+        """ Listener, called from the reader task """
+        if self.closed or self.overflowed:
+            return
+        if msg['type'] == 'micro_block_reverted':
+            self.revert(msg)
+            return
+        if self.expected is not None and block_key(msg) < self.expected:
+            return
+        self.expected = next_position(msg)
+        self.push(msg)
+
+    def revert(self, msg):
+        reverted = block_position(msg)
+        while self.queue and block_key(self.queue[-1]) >= reverted:
+            self.queue.pop()
+        self.expected = reverted
+        if self.position is None or self.position > reverted:
+            self.push(msg)
+
+    def push(self, msg):
+        if len(self.queue) >= self.maxsize:
+            if self.overflow == DROP_OLDEST:
+                self.queue.popleft()
+                self.dropped += 1
+            elif self.overflow == ERROR:
+                self.overflowed = True
+                self.client.remove_listener(self.on_block)
+                self.wake()
+                return
+        self.queue.append(msg)
+        if self.overflow == BLOCK and len(self.queue) >= self.maxsize:
+            self.client.pause(self)
+        self.wake()
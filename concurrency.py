@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+import asyncio
+import contextlib
+import logging
+import random
+import time
+
+from metrics import CONCURRENCY_LIMIT, PAYMENTS_IN_FLIGHT
+
+# Payments in flight per node: start value and bounds of the limit
+INITIAL_LIMIT = 8
+MIN_LIMIT = 1
+MAX_LIMIT = 256
+# Confirmation latency above baseline * TOLERANCE means payments queue up at the node
+TOLERANCE = 2.0
+# Share of failed payments (rejected, conflicted, errors, timeouts) above which the node is backed off
+MAX_ERROR_RATE = 0.2
+# Multiplicative decrease of the limit on queueing or failures
+DECREASE = 0.7
+# Weight of a new sample in the smoothed latency and the error rate (averaged
+# over more payments than latency, so occasional conflicts don't trigger it)
+SMOOTHING = 0.1
+ERROR_SMOOTHING = 0.05
+# The baseline (long-term latency) moves this much towards the smoothed
+# latency once per smoothed latency, independently of payment rate. It only
+# goes up while the limit isn't reached, when higher latency can't be caused
+# by our own load.
+BASELINE_SMOOTHING = 0.05
+# Successes before the smoothed latency is trusted as a baseline
+WARMUP = 30
+# Pause of a node failing at the minimum limit: first delay and upper bound in seconds
+PAUSE_BASE = 1.0
+PAUSE_MAX = 60.0
+
+
+class Sample:
+    def __init__(self):
+        """ Outcome of one payment holding a slot, reported with success()
+        or failure(). Payments without an outcome (e.g. balance too low,
+        cancelled) release the slot without teaching the limit anything.
+        """
+        self.start = time.monotonic()
+        self.latency = None
+        self.ok = None
+
+    def success(self):
+        self.latency = time.monotonic() - self.start
+        self.ok = True
+
+    def failure(self):
+        self.latency = time.monotonic() - self.start
+        self.ok = False
+
+
+class AdaptiveLimit:
+    def __init__(self, node_id, initial=INITIAL_LIMIT, min_limit=MIN_LIMIT, max_limit=MAX_LIMIT,
+                 tolerance=TOLERANCE, decrease=DECREASE, max_error_rate=MAX_ERROR_RATE):
+        """ AIMD limit of payments in flight to one node
+        While smoothed confirmation latency stays within tolerance times the
+        baseline (long-term latency) the limit grows by one per success
+        until the first decrease and after pauses (slow start), otherwise by
+        one per limit successes (about one per round of confirmations), as
+        long as the limit is actually reached. It is cut by decrease, at
+        most once per smoothed latency, when latency grows past that or the
+        smoothed error rate exceeds max_error_rate. A node which keeps
+        failing at min_limit is paused with exponential backoff, other nodes
+        aren't affected.
+        Averages rather than single latencies are compared, as
+        confirmations arrive in micro blocks and a single payment may take
+        anything between zero and a block interval.
+        Attributes:
+            limit (float): current limit, int(limit) slots are available
+            in_flight (int): slots taken
+            baseline (float): long-term latency, seconds
+            latency (float): smoothed confirmation latency, seconds
+            error_rate (float): smoothed share of failed payments
+            failures (int): consecutive failures
+            pauses (int): consecutive pauses, the exponent of the next pause
+            paused_until (float): time.monotonic() before which no slot is given
+        """
+        self.node_id = node_id
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.decrease = decrease
+        self.max_error_rate = max_error_rate
+        self.in_flight = 0
+        self.baseline = None
+        self.baseline_at = 0.0
+        self.latency = None
+        self.samples = 0
+        self.error_rate = 0.0
+        self.slow_start = True
+        self.failures = 0
+        self.pauses = 0
+        self.decreased_at = 0.0
+        self.paused_at = 0.0
+        self.paused_until = 0.0
+        self.waiters = []
+        self.limit_gauge = CONCURRENCY_LIMIT.labels(node=node_id)
+        self.in_flight_gauge = PAYMENTS_IN_FLIGHT.labels(node=node_id)
+        self.limit_gauge.set(int(self.limit))
+
+    def available(self):
+        return max(0, int(self.limit) - self.in_flight)
+
+    async def acquire(self):
+        while True:
+            delay = self.paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            if self.available() > 0:
+                self.in_flight += 1
+                self.in_flight_gauge.inc()
+                return
+            fut = asyncio.get_event_loop().create_future()
+            self.waiters.append(fut)
+            try:
+                await fut
+            except asyncio.CancelledError:
+                if fut.done() and not fut.cancelled():
+                    # Pass the wakeup on to the next waiter
+                    self.wake()
+                raise
+            finally:
+                if fut in self.waiters:
+                    self.waiters.remove(fut)
+
+    def wake(self):
+        for _ in range(0, min(self.available(), len(self.waiters))):
+            fut = self.waiters.pop(0)
+            if not fut.done():
+                fut.set_result(None)
+
+    def release(self, sample):
+        # Only a limit which is reached says something about the node
+        saturated = self.in_flight >= int(self.limit)
+        self.in_flight -= 1
+        self.in_flight_gauge.dec()
+        if sample.ok is True:
+            self.succeeded(sample.latency, saturated)
+        elif sample.ok is False:
+            self.failed(sample)
+        self.wake()
+
+    def observe(self, latency, saturated):
+        self.latency = latency if self.latency is None else self.latency + (latency - self.latency) * SMOOTHING
+        self.samples += 1
+        now = time.monotonic()
+        if self.samples == WARMUP:
+            self.baseline = self.latency
+            self.baseline_at = now
+        elif self.samples > WARMUP and now - self.baseline_at >= self.latency:
+            if self.latency < self.baseline or not saturated:
+                self.baseline += (self.latency - self.baseline) * BASELINE_SMOOTHING
+            self.baseline_at = now
+
+    def succeeded(self, latency, saturated):
+        self.failures = 0
+        self.pauses = 0
+        self.error_rate -= self.error_rate * ERROR_SMOOTHING
+        self.observe(latency, saturated)
+        queueing = self.baseline is not None and self.latency > self.baseline * self.tolerance
+        if queueing or self.error_rate > self.max_error_rate:
+            self.cut()
+        elif saturated:
+            self.set_limit(self.limit + (1.0 if self.slow_start else 1.0 / self.limit))
+
+    def failed(self, sample):
+        self.failures += 1
+        self.error_rate += (1.0 - self.error_rate) * ERROR_SMOOTHING
+        if self.error_rate <= self.max_error_rate:
+            return
+        if self.limit > self.min_limit:
+            self.cut()
+        elif sample.start >= self.paused_at:
+            # Payments sent before the last pause don't extend it
+            now = time.monotonic()
+            delay = min(PAUSE_MAX, PAUSE_BASE * 2 ** self.pauses) * random.uniform(0.5, 1.0)
+            self.pauses += 1
+            # Like TCP after a timeout: probe from min_limit up again quickly
+            self.slow_start = True
+            self.paused_at = now
+            self.paused_until = now + delay
+            logging.info(f"{self.node_id}: {self.failures} payments failed in a row, pausing for {delay:.1f}s")
+
+    def cut(self):
+        """ Multiplicative decrease, once per smoothed latency """
+        now = time.monotonic()
+        if now - self.decreased_at > (self.latency or 0.0):
+            self.decreased_at = now
+            self.slow_start = False
+            self.set_limit(self.limit * self.decrease)
+
+    def set_limit(self, limit):
+        self.limit = min(self.max_limit, max(self.min_limit, limit))
+        self.limit_gauge.set(int(self.limit))
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """ Hold a slot for one payment, yields the Sample to report its outcome on """
+        await self.acquire()
+        sample = Sample()
+        try:
+            yield sample
+        except Exception:
+            sample.failure()
+            raise
+        finally:
+            self.release(sample)
+
+
+@contextlib.asynccontextmanager
+async def unlimited():
+    """ slot() of clients without a limit """
+    yield Sample()
+
+
+class ConcurrencyController:
+    def __init__(self, initial=INITIAL_LIMIT, min_limit=MIN_LIMIT, max_limit=MAX_LIMIT, tolerance=TOLERANCE):
+        """ AdaptiveLimit per node, shared by all connections to it
+        Attributes:
+            limits: node_id -> AdaptiveLimit
+        """
+        self.initial = initial
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.limits = {}
+
+    def limit(self, node_id):
+        limit = self.limits.get(node_id)
+        if limit is None:
+            limit = self.limits[node_id] = AdaptiveLimit(node_id, self.initial, self.min_limit,
+                                                         self.max_limit, self.tolerance)
+        return limit
+
+    def summary(self):
+        return ' '.join(f"{node_id}={int(limit.limit)}" for node_id, limit in sorted(self.limits.items()))
+
+
+def add_arguments(parser):
+    parser.add_argument('--adaptive', action='store_true',
+                        help="adapt payments in flight per node to confirmation latency and failures")
+    parser.add_argument('--initial-limit', type=int, default=INITIAL_LIMIT,
+                        help="payments in flight per node to start with (--adaptive)")
+    parser.add_argument('--max-limit', type=int, default=MAX_LIMIT,
+                        help="upper bound of payments in flight per node (--adaptive)")
+
+
+def from_args(args):
+    """ ConcurrencyController of add_arguments() options, None without --adaptive """
+    if not args.adaptive:
+        return None
+    return ConcurrencyController(args.initial_limit, max_limit=args.max_limit)
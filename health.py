@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+import random
+import time
+
+from metrics import NODE_ERROR_RATE, NODE_HEALTH, NODE_LAG, NODE_RTT
+
+# Requests whose round trip shows how responsive a node is (secure payments
+# wait for Snowball, account creation for key derivation)
+RTT_TYPES = frozenset(['status_info', 'subscribe_status', 'balance_info', 'account_info', 'list_accounts',
+                       'history_info', 'payment', 'validate_certificate'])
+# Weight of a new sample in the smoothed round trip and error rate
+SMOOTHING = 0.1
+# Seconds added to round trips before comparing them, so differences of a
+# few milliseconds (noise) don't matter
+RTT_FLOOR = 0.01
+# Blocks a node may be behind the most advanced one (propagation), and the
+# score factor per block beyond that
+LAG_TOLERANCE = 1
+LAG_PENALTY = 0.5
+# Seconds without status_changed after which a node is considered stuck
+STATUS_TIMEOUT = 60.0
+# Score factor per connection lost within RECONNECT_WINDOW seconds
+RECONNECT_PENALTY = 0.5
+RECONNECT_WINDOW = 300.0
+
+
+class NodeHealth:
+    def __init__(self, node_id):
+        """ What the connections to one node saw of it
+        Attributes:
+            synchronized (bool): last status_changed said so, reset on connection loss
+            position: (epoch, offset) of the last status_changed
+            status_at (float): time.monotonic() of the last status_changed
+            rtt (float): smoothed request round trip, seconds
+            error_rate (float): smoothed share of failed requests
+            losses: time.monotonic() of connection losses within RECONNECT_WINDOW
+            score (float): last score given by HealthMonitor.scores()
+        """
+        self.node_id = node_id
+        self.synchronized = False
+        self.position = None
+        self.status_at = 0.0
+        self.rtt = None
+        self.error_rate = 0.0
+        self.losses = []
+        self.score = 0.0
+        self.health_gauge = NODE_HEALTH.labels(node=node_id)
+        self.rtt_gauge = NODE_RTT.labels(node=node_id)
+        self.error_gauge = NODE_ERROR_RATE.labels(node=node_id)
+        self.lag_gauge = NODE_LAG.labels(node=node_id)
+
+    def status(self, msg):
+        self.synchronized = msg.is_synchronized
+        self.position = (msg.epoch, msg.offset)
+        self.status_at = time.monotonic()
+
+    def request(self, req_type, elapsed):
+        self.error_rate -= self.error_rate * SMOOTHING
+        if req_type in RTT_TYPES:
+            self.rtt = elapsed if self.rtt is None else self.rtt + (elapsed - self.rtt) * SMOOTHING
+
+    def failed(self):
+        """ Request got no response: connection lost or timed out """
+        self.error_rate += (1.0 - self.error_rate) * SMOOTHING
+
+    def disconnected(self):
+        # Not known to be synchronized until the next status_changed
+        self.synchronized = False
+        self.losses.append(time.monotonic())
+
+    def usable(self, now):
+        return self.synchronized and now - self.status_at < STATUS_TIMEOUT
+
+    def lag(self, best):
+        """ Blocks behind best position, at least the offset of best if in an older epoch """
+        if self.position is None or best is None or self.position >= best:
+            return 0
+        if self.position[0] == best[0]:
+            return best[1] - self.position[1]
+        return best[1] + 1
+
+
+class HealthMonitor:
+    def __init__(self):
+        """ NodeHealth of every node and scores to route requests by
+        A node scores 0 while it isn't synchronized or hasn't sent a status
+        for STATUS_TIMEOUT. Otherwise the score is the product of: fastest
+        round trip / its round trip (both plus RTT_FLOOR), 1 - error rate,
+        LAG_PENALTY per block behind the most advanced node (beyond
+        LAG_TOLERANCE) and RECONNECT_PENALTY per recent connection loss. The
+        best node has a score close to 1.
+        Attributes:
+            nodes: node_id -> NodeHealth, shared by all connections to the node
+        """
+        self.nodes = {}
+
+    def node(self, node_id):
+        health = self.nodes.get(node_id)
+        if health is None:
+            health = self.nodes[node_id] = NodeHealth(node_id)
+        return health
+
+    def scores(self):
+        """ Score every node and export scores, returns node_id -> score """
+        now = time.monotonic()
+        usable = [h for h in self.nodes.values() if h.usable(now)]
+        best = max((h.position for h in usable if h.position is not None), default=None)
+        fastest = min((h.rtt for h in usable if h.rtt is not None), default=None)
+        for health in self.nodes.values():
+            health.losses = [t for t in health.losses if now - t < RECONNECT_WINDOW]
+            lag = health.lag(best)
+            if not health.usable(now):
+                score = 0.0
+            else:
+                score = 1.0 - health.error_rate
+                if fastest is not None and health.rtt is not None:
+                    score *= (fastest + RTT_FLOOR) / (health.rtt + RTT_FLOOR)
+                score *= LAG_PENALTY ** max(0, lag - LAG_TOLERANCE)
+                score *= RECONNECT_PENALTY ** len(health.losses)
+            health.score = score
+            health.health_gauge.set(score)
+            health.lag_gauge.set(lag)
+            health.error_gauge.set(health.error_rate)
+            if health.rtt is not None:
+                health.rtt_gauge.set(health.rtt)
+        return {node_id: health.score for node_id, health in self.nodes.items()}
+
+    def pick(self, node_ids=None):
+        """ Random node of node_ids (all known by default) weighted by score,
+        so faster nodes get more requests without all of them landing on
+        one node. Any of them if none is usable.
+        """
+        scores = self.scores()
+        node_ids = list(scores if node_ids is None else node_ids)
+        weights = [scores.get(node_id, 0.0) for node_id in node_ids]
+        if sum(weights) <= 0:
+            return random.choice(node_ids)
+        return random.choices(node_ids, weights)[0]
+
+    def summary(self):
+        return ' '.join(f"{node_id}={score:.2f}" for node_id, score in sorted(self.scores().items()))
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import logging
+import runrecord
+import sqlite3
+import stegos
+import time
+
+from chainstream import block_position
+from provision import client_from_node
+
+# Blocks written per transaction, and max seconds a block waits to be written
+BATCH_SIZE = 500
+BATCH_DELAY = 1.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blocks (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    epoch INTEGER NOT NULL,
+    offset INTEGER,
+    hash TEXT NOT NULL UNIQUE,
+    timestamp TEXT
+);
+CREATE TABLE IF NOT EXISTS transactions (
+    tx_hash TEXT PRIMARY KEY,
+    block_id INTEGER NOT NULL,
+    epoch INTEGER NOT NULL,
+    offset INTEGER
+);
+CREATE TABLE IF NOT EXISTS outputs (
+    utxo TEXT PRIMARY KEY,
+    tx_hash TEXT NOT NULL,
+    block_id INTEGER NOT NULL,
+    epoch INTEGER NOT NULL,
+    output_type TEXT,
+    recipient TEXT,
+    amount INTEGER,
+    spent_tx TEXT
+);
+CREATE TABLE IF NOT EXISTS checkpoint (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    epoch INTEGER NOT NULL,
+    offset INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS blocks_epoch ON blocks (epoch, offset);
+CREATE INDEX IF NOT EXISTS transactions_block ON transactions (block_id);
+CREATE INDEX IF NOT EXISTS transactions_epoch ON transactions (epoch);
+CREATE INDEX IF NOT EXISTS outputs_tx_hash ON outputs (tx_hash);
+CREATE INDEX IF NOT EXISTS outputs_recipient ON outputs (recipient);
+CREATE INDEX IF NOT EXISTS outputs_epoch ON outputs (epoch);
+CREATE INDEX IF NOT EXISTS outputs_spent_tx ON outputs (spent_tx);
+"""
+
+
+def block_transactions(msg):
+    """ Yield (tx_hash, inputs, outputs) of a micro block notification
+    inputs are spent utxo hashes, outputs are dicts with utxo/recipient/amount
+    """
+    for tx in msg.get('transactions', []):
+        inputs = tx.get('inputs', tx.get('txins', []))
+        inputs = [i if isinstance(i, str) else i.get('utxo') for i in inputs]
+        yield tx['tx_hash'], inputs, tx.get('outputs', tx.get('txouts', []))
+
+
+class ChainIndex:
+    def __init__(self, path):
+        """ SQLite store of blocks, transactions and outputs
+        Attributes:
+            path (String): database file, created if missing
+        Every write() is one database transaction, checkpoint included, so
+        the index is always consistent with the checkpoint.
+        """
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def checkpoint(self):
+        """ (epoch, offset) to resume from, None for an empty index """
+        row = self.db.execute("SELECT epoch, offset FROM checkpoint WHERE id = 0").fetchone()
+        return None if row is None else tuple(row)
+
+    def write(self, messages, position):
+        """ Apply chain notifications in order and move checkpoint to position """
+        blocks, txs, outputs, spent = [], [], [], []
+
+        def flush():
+            self.insert(blocks, txs, outputs, spent)
+            blocks.clear()
+            txs.clear()
+            outputs.clear()
+            spent.clear()
+
+        with self.db:
+            for msg in messages:
+                if msg['type'] == 'micro_block_reverted':
+                    flush()
+                    self.revert(*block_position(msg))
+                    continue
+                epoch, offset = block_position(msg)
+                header = msg.get('header', msg)
+                kind = 'macro' if msg['type'] == 'macro_block_committed' else 'micro'
+                blocks.append((kind, epoch, offset, header['hash'], header.get('timestamp')))
+                for tx_hash, inputs, tx_outputs in block_transactions(msg):
+                    txs.append((tx_hash, header['hash'], epoch, offset))
+                    spent.extend((tx_hash, utxo) for utxo in inputs)
+                    outputs.extend((o['utxo'], tx_hash, header['hash'], epoch, o.get('output_type'),
+                                    o.get('recipient'), o.get('amount')) for o in tx_outputs)
+            flush()
+            self.db.execute("INSERT OR REPLACE INTO checkpoint (id, epoch, offset) VALUES (0, ?, ?)", position)
+
+    def insert(self, blocks, txs, outputs, spent):
+        self.db.executemany(
+            "INSERT OR IGNORE INTO blocks (kind, epoch, offset, hash, timestamp) VALUES (?, ?, ?, ?, ?)", blocks)
+        self.db.executemany(
+            "INSERT OR REPLACE INTO transactions (tx_hash, block_id, epoch, offset) "
+            "SELECT ?, id, ?, ? FROM blocks WHERE hash = ?",
+            [(tx_hash, epoch, offset, block_hash) for tx_hash, block_hash, epoch, offset in txs])
+        self.db.executemany(
+            "INSERT OR REPLACE INTO outputs (utxo, tx_hash, block_id, epoch, output_type, recipient, amount) "
+            "SELECT ?, ?, id, ?, ?, ?, ? FROM blocks WHERE hash = ?",
+            [(utxo, tx_hash, epoch, output_type, recipient, amount, block_hash)
+             for utxo, tx_hash, block_hash, epoch, output_type, recipient, amount in outputs])
+        self.db.executemany("UPDATE outputs SET spent_tx = ? WHERE utxo = ?", spent)
+
+    def revert(self, epoch, offset):
+        """ Remove micro blocks of epoch from offset on, with their transactions """
+        reverted = "SELECT id FROM blocks WHERE kind = 'micro' AND epoch = ? AND offset >= ?"
+        self.db.execute(f"UPDATE outputs SET spent_tx = NULL WHERE spent_tx IN "
+                        f"(SELECT tx_hash FROM transactions WHERE block_id IN ({reverted}))", (epoch, offset))
+        self.db.execute(f"DELETE FROM outputs WHERE block_id IN ({reverted})", (epoch, offset))
+        self.db.execute(f"DELETE FROM transactions WHERE block_id IN ({reverted})", (epoch, offset))
+        self.db.execute(f"DELETE FROM blocks WHERE id IN ({reverted})", (epoch, offset))
+        logging.info(f"Index: reverted epoch {epoch} from offset {offset}")
+
+    def find_tx(self, tx_hash):
+        return self.db.execute(
+            "SELECT t.tx_hash, t.epoch, t.offset, b.hash, b.timestamp FROM transactions t "
+            "JOIN blocks b ON b.id = t.block_id WHERE t.tx_hash = ?", (tx_hash,)).fetchone()
+
+    def find_utxo(self, utxo):
+        return self.db.execute(
+            "SELECT utxo, tx_hash, epoch, output_type, recipient, amount, spent_tx FROM outputs WHERE utxo = ?",
+            (utxo,)).fetchone()
+
+    def outputs_of(self, recipient):
+        return self.db.execute(
+            "SELECT utxo, tx_hash, epoch, output_type, recipient, amount, spent_tx FROM outputs "
+            "WHERE recipient = ? ORDER BY epoch", (recipient,)).fetchall()
+
+
+async def batches(stream, size=BATCH_SIZE, delay=BATCH_DELAY):
+    """ Group stream items in lists of at most `size`, waiting at most `delay` """
+    batch = []
+    deadline = None
+    while True:
+        timeout = None if not batch else max(0.0, deadline - time.monotonic())
+        try:
+            msg = await asyncio.wait_for(stream.__anext__(), timeout)
+        except asyncio.TimeoutError:
+            msg = None
+        except StopAsyncIteration:
+            break
+        if msg is not None:
+            if not batch:
+                deadline = time.monotonic() + delay
+            batch.append(msg)
+        if batch and (msg is None or len(batch) >= size):
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def run_indexer(node, index, epoch=None, batch_size=BATCH_SIZE, batch_delay=BATCH_DELAY):
+    """ Index chain of node forever, resuming from the checkpoint """
+    start = index.checkpoint() or (epoch, 0)
+    logging.info(f"Index: {node['node_id']} from epoch={start[0]}, offset={start[1]}")
+    client = await client_from_node(node)
+    try:
+        async with client.chain(*start) as stream:
+            async for batch in batches(stream, batch_size, batch_delay):
+                index.write(batch, stream.position)
+                logging.info(f"Index: {len(batch)} blocks, at epoch={stream.position[0]}, offset={stream.position[1]}")
+    finally:
+        await client.close()
+
+
+def audit(index, paths):
+    """ Check that transactions of RunRecorder files are in the index """
+    found = missing = 0
+    for path in paths:
+        for record in runrecord.read_records(path):
+            if not record.get('tx_hash'):
+                continue
+            if index.find_tx(record['tx_hash']) is None:
+                missing += 1
+                print(f"missing: {record['tx_hash']} ({record['node']}[{record['account']}], outcome={record['outcome']})")
+            else:
+                found += 1
+    print(f"Indexed: {found}, missing: {missing}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Index chain of a Stegos node into SQLite")
+    parser.add_argument('--db', default='chain.sqlite', help="index database")
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help="follow the chain, resuming from the checkpoint")
+    run.add_argument('--nodes', default='sample.json', help="nodes file in sample.json format")
+    run.add_argument('--node', default=None, help="node_id to index, first node by default")
+    run.add_argument('--epoch', type=int, default=None, help="first epoch of an empty index, current by default")
+    run.add_argument('--batch', type=int, default=BATCH_SIZE, help="blocks per database transaction")
+    commands.add_parser('tx', help="find transaction").add_argument('tx_hash')
+    commands.add_parser('utxo', help="find output").add_argument('utxo')
+    commands.add_parser('recipient', help="outputs paid to address").add_argument('address')
+    commands.add_parser('audit', help="check transactions of run record files").add_argument('files', nargs='+')
+    args = parser.parse_args()
+
+    index = ChainIndex(args.db)
+    if args.command == 'run':
+        logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+        nodes = stegos.load_nodes(args.nodes)
+        node = nodes[0] if args.node is None else next(n for n in nodes if n['node_id'] == args.node)
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(run_indexer(node, index, args.epoch, args.batch))
+    elif args.command == 'tx':
+        print(index.find_tx(args.tx_hash))
+    elif args.command == 'utxo':
+        print(index.find_utxo(args.utxo))
+    elif args.command == 'recipient':
+        for row in index.outputs_of(args.address):
+            print(row)
+    elif args.command == 'audit':
+        audit(index, args.files)
+    index.close()
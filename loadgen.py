@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import concurrency
+import logging
+import logsetup
+import random
+import shards
+import stegos
+import time
+
+from planner import PaymentPlanner
+from pool import NodeUnavailable, StegosPool
+from prometheus_client import start_http_server
+from runrecord import RunRecorder
+
+# Arrivals dropped instead of sent once this many payments are unconfirmed
+MAX_IN_FLIGHT = 10_000
+
+
+class Constant:
+    def __init__(self, tps):
+        self.tps = tps
+
+    def rate(self, t):
+        return self.tps
+
+
+class Step:
+    def __init__(self, start, step, interval, limit=None):
+        """ Start at `start` TPS and add `step` TPS every `interval` seconds """
+        self.start = start
+        self.step = step
+        self.interval = interval
+        self.limit = limit
+
+    def rate(self, t):
+        tps = self.start + self.step * int(t // self.interval)
+        return tps if self.limit is None else min(tps, self.limit)
+
+
+class Ramp:
+    def __init__(self, start, end, duration):
+        """ Linear change from `start` to `end` TPS over `duration` seconds """
+        self.start = start
+        self.end = end
+        self.duration = duration
+
+    def rate(self, t):
+        if t >= self.duration:
+            return self.end
+        return self.start + (self.end - self.start) * t / self.duration
+
+
+class Spike:
+    def __init__(self, base, peak, at, length):
+        """ `base` TPS with `peak` TPS between `at` and `at + length` seconds """
+        self.base = base
+        self.peak = peak
+        self.at = at
+        self.length = length
+
+    def rate(self, t):
+        if self.at <= t < self.at + self.length:
+            return self.peak
+        return self.base
+
+
+class Scaled:
+    def __init__(self, profile, factor):
+        """ Share of another profile, e.g. the part offered by one worker """
+        self.profile = profile
+        self.factor = factor
+
+    def rate(self, t):
+        return self.profile.rate(t) * self.factor
+
+
+PROFILES = {
+    'constant': Constant,
+    'step': Step,
+    'ramp': Ramp,
+    'spike': Spike,
+}
+
+
+def parse_profile(spec):
+    """ Parse profile spec like 'ramp:1:100:600' (name:arg:arg...) """
+    name, *args = spec.split(':')
+    if name not in PROFILES:
+        raise ValueError(f"Unknown profile '{name}', expected one of {', '.join(PROFILES)}")
+    return PROFILES[name](*[float(a) for a in args])
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=1.0):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1.0:
+            return False
+        self.tokens -= 1.0
+        return True
+
+
+class Account:
+    def __init__(self, node_id, account_id, dest, rate=None):
+        self.node_id = node_id
+        self.account_id = account_id
+        self.dest = dest
+        self.bucket = None if rate is None else TokenBucket(rate)
+
+
+def accounts_from_nodes(nodes, account_rate=None):
+    """ Every account pays to the account with the same index on the next node """
+    accounts = []
+    for n in range(0, len(nodes)):
+        ids = sorted(nodes[n]['accounts'].keys())
+        dest_node = nodes[(n + 1) % len(nodes)]
+        dest_ids = sorted(dest_node['accounts'].keys())
+        for i in range(0, len(ids)):
+            dest = dest_node['accounts'][dest_ids[i % len(dest_ids)]]
+            accounts.append(Account(nodes[n]['node_id'], ids[i], dest, account_rate))
+    return accounts
+
+
+class LoadGenerator:
+    def __init__(self, pool, accounts, profile, duration=None, secure=False, amount=0.001,
+                 max_in_flight=MAX_IN_FLIGHT, report_interval=10.0, planner=None, route=False):
+        """ Open-loop payment generator
+        Payments arrive as a Poisson process with the rate given by profile,
+        independently of how fast earlier payments complete.
+        Attributes:
+            pool (StegosPool): connections to the nodes
+            accounts: list of Account, used round-robin
+            profile: object with rate(t) -> target TPS at t seconds from start
+            duration (float): stop offering load after this many seconds
+            secure (bool): send secure_payment (Snowball) instead of payment
+            amount (float): tokens per payment
+            planner (PaymentPlanner): queue payments of an account until it has free outputs
+            route (bool): pay from accounts of a node picked by health score
+                          (see health.py) instead of all accounts in turn
+        """
+        self.pool = pool
+        self.accounts = accounts
+        self.profile = profile
+        self.duration = duration
+        self.secure = secure
+        self.amount = amount
+        self.max_in_flight = max_in_flight
+        self.report_interval = report_interval
+        self.planner = planner
+        self.route = route
+        self.next_account = 0
+        # Accounts of each node and the next one to use, for route
+        self.by_node = {}
+        for account in accounts:
+            self.by_node.setdefault(account.node_id, []).append(account)
+        self.next_by_node = {node_id: 0 for node_id in self.by_node}
+        self.tasks = set()
+        self.offered = 0
+        self.limited = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.latencies = []
+        self.all_latencies = []
+        self.reported = (0, 0, 0, 0)
+        self.elapsed = 0.0
+
+    def pick_account(self, now):
+        """ Next account (round-robin) whose rate limit allows a payment,
+        with route an account of the node picked by health if it has one.
+        """
+        if self.route:
+            node_id = self.pool.pick(self.by_node)
+            accounts = self.by_node[node_id]
+            for _ in range(0, len(accounts)):
+                account = accounts[self.next_by_node[node_id]]
+                self.next_by_node[node_id] = (self.next_by_node[node_id] + 1) % len(accounts)
+                if account.bucket is None or account.bucket.take(now):
+                    return account
+        for _ in range(0, len(self.accounts)):
+            account = self.accounts[self.next_account]
+            self.next_account = (self.next_account + 1) % len(self.accounts)
+            if account.bucket is None or account.bucket.take(now):
+                return account
+        return None
+
+    async def run(self, stop=None):
+        """ Offer load until duration is over or stop (asyncio.Event) is set """
+        start = time.monotonic()
+        next_report = start + self.report_interval
+        next_arrival = start
+        while True:
+            now = time.monotonic()
+            t = now - start
+            if self.duration is not None and t >= self.duration:
+                break
+            if stop is not None and stop.is_set():
+                break
+            if now >= next_report:
+                self.report(self.report_interval)
+                next_report += self.report_interval
+            rate = self.profile.rate(t)
+            if rate <= 0:
+                await asyncio.sleep(0.1)
+                next_arrival = time.monotonic()
+                continue
+            # Schedule on absolute time, so late wakeups don't lower the offered rate
+            next_arrival += random.expovariate(rate)
+            delay = next_arrival - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            self.offered += 1
+            account = self.pick_account(time.monotonic())
+            if account is None or len(self.tasks) >= self.max_in_flight:
+                self.limited += 1
+                continue
+            task = asyncio.ensure_future(self.send(account))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+        logging.info(f"Load finished, waiting for {len(self.tasks)} payments in flight")
+        if self.tasks:
+            await asyncio.wait(self.tasks)
+        self.elapsed = time.monotonic() - start
+        self.report(self.elapsed, total=True)
+
+    async def send(self, account):
+        start = time.monotonic()
+        try:
+            async with self.pool.lease(account.node_id) as client:
+                if self.planner is not None:
+                    self.planner.watch(client)
+                    result = await self.planner.pay(client, account.account_id, account.dest, self.amount,
+                                                    secure=self.secure)
+                    ok = result['success']
+                elif self.secure:
+                    result = await client.secure_payment_with_confirmation(
+                        account.account_id, account.dest, self.amount)
+                    ok = result['success']
+                else:
+                    result = await client.payment_with_confirmation(
+                        account.account_id, account.dest, self.amount)
+                    ok = result['success']
+        except Exception as e:
+            logging.info(f"{account.node_id}[{account.account_id}] payment failed: {e}")
+            ok = False
+        if ok:
+            self.succeeded += 1
+            self.latencies.append(time.monotonic() - start)
+        else:
+            self.failed += 1
+
+    def report(self, interval, total=False):
+        """ Log rates and latency since the last report (whole run if total) """
+        counts = (self.offered, self.limited, self.succeeded, self.failed)
+        if total:
+            offered, limited, succeeded, failed = counts
+            latencies = sorted(self.all_latencies + self.latencies)
+        else:
+            offered, limited, succeeded, failed = [c - r for c, r in zip(counts, self.reported)]
+            latencies = sorted(self.latencies)
+            self.reported = counts
+            self.all_latencies.extend(self.latencies)
+            self.latencies = []
+        log_report("Total" if total else "Last", interval,
+                   offered, limited, succeeded, failed, len(self.tasks), latencies)
+        if self.pool.controller is not None:
+            logging.info(f"Payment limits: {self.pool.controller.summary()}")
+        if self.route:
+            logging.info(f"Node health: {self.pool.health.summary()}")
+
+    def totals(self):
+        """ Counters of the whole run, to be merged with other workers """
+        return {
+            'elapsed': self.elapsed,
+            'offered': self.offered,
+            'limited': self.limited,
+            'succeeded': self.succeeded,
+            'failed': self.failed,
+            'latencies': self.all_latencies + self.latencies,
+        }
+
+
+def log_report(label, interval, offered, limited, succeeded, failed, in_flight, latencies):
+    if latencies:
+        p50 = latencies[len(latencies) // 2]
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        lat = f"p50={p50:.3f}s p99={p99:.3f}s"
+    else:
+        lat = "no confirmations"
+    logging.info(
+        f"{label} {interval:.0f}s: offered={offered} ({offered / interval:.1f}/s) "
+        f"limited={limited} ok={succeeded} ({succeeded / interval:.1f}/s) "
+        f"failed={failed} in_flight={in_flight} {lat}")
+
+
+async def my_app(args, accounts=None, profile=None, record=None, stop=None):
+    """ Run the load generator on accounts (all accounts of args.nodes by default) """
+    nodes = stegos.load_nodes(args.nodes)
+    profile = profile or parse_profile(args.profile)
+    if accounts is None:
+        accounts = accounts_from_nodes(nodes, args.account_rate)
+    else:
+        # Only connect to nodes this shard pays from
+        node_ids = set(a.node_id for a in accounts)
+        nodes = [n for n in nodes if n['node_id'] in node_ids]
+    recorder = None
+    if record is not None:
+        recorder = RunRecorder(record)
+        recorder.start()
+    pool = StegosPool(nodes, max_connections=args.connections, recorder=recorder, capture_dir=args.capture,
+                      controller=concurrency.from_args(args))
+    await pool.start()
+    planner = None
+    if args.plan:
+        planner = PaymentPlanner()
+        splits = []
+        for account in accounts:
+            try:
+                client = await pool.acquire(account.node_id, lease=False)
+            except NodeUnavailable as e:
+                logging.info(f"Not splitting {account.node_id}[{account.account_id}]: {e}")
+                continue
+            planner.watch(client)
+            splits.append(planner.split(client, account.account_id, args.plan, args.amount))
+        await asyncio.gather(*splits)
+    generator = LoadGenerator(pool, accounts, profile, duration=args.duration, secure=args.secure,
+                              amount=args.amount, planner=planner, route=args.route)
+    await generator.run(stop)
+    await pool.close()
+    if recorder is not None:
+        await recorder.close()
+    return generator.totals()
+
+
+async def shard_worker(accounts, index, args, stop):
+    """ One worker process of a sharded run, offers its share of the load """
+    profile = Scaled(parse_profile(args.profile), len(accounts) / args.total_accounts)
+    record = None if args.record is None else f"{args.record}.{index}"
+    return await my_app(args, accounts, profile, record, stop)
+
+
+def run_sharded(args):
+    """ Split accounts across args.workers processes and merge their totals """
+    accounts = accounts_from_nodes(stegos.load_nodes(args.nodes), args.account_rate)
+    args.total_accounts = len(accounts)
+    results = shards.run_workers(shard_worker, shards.split(accounts, args.workers), args, args.metrics_port)
+    done = [r for r in results if r is not None]
+    if len(done) < len(results):
+        logging.info(f"{len(results) - len(done)} of {len(results)} workers failed")
+    if not done:
+        return
+    latencies = sorted(lat for r in done for lat in r['latencies'])
+    log_report(f"Total of {len(done)} workers", max(r['elapsed'] for r in done),
+               *[sum(r[k] for r in done) for k in ('offered', 'limited', 'succeeded', 'failed')], 0, latencies)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Open-loop payment load generator")
+    parser.add_argument('--nodes', default="sample.json", help="nodes config file")
+    parser.add_argument('--profile', default="constant:10",
+                        help="constant:TPS, step:START:STEP:INTERVAL[:MAX], ramp:START:END:SECS or spike:BASE:PEAK:AT:SECS")
+    parser.add_argument('--duration', type=float, default=None, help="seconds to run, forever if omitted")
+    parser.add_argument('--account-rate', type=float, default=None, help="max TPS per account")
+    parser.add_argument('--secure', action='store_true', help="send Snowball secure payments")
+    parser.add_argument('--amount', type=float, default=0.001, help="tokens per payment")
+    parser.add_argument('--connections', type=int, default=2, help="connections per node")
+    parser.add_argument('--record', default=None, help="append payment records to this file (see runrecord.py)")
+    parser.add_argument('--metrics-port', type=int, default=8892, help="Prometheus exporter port")
+    parser.add_argument('--plan', type=int, default=0,
+                        help="split every account into this many outputs and queue payments until outputs are free")
+    parser.add_argument('--route', action='store_true',
+                        help="send each payment from an account of a node picked by health score (see health.py)")
+    parser.add_argument('--capture', default=None, help="record frames of every connection to files in this directory")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="worker processes, accounts are split between them (record files get .N suffix)")
+    concurrency.add_arguments(parser)
+    logsetup.add_arguments(parser)
+    args = parser.parse_args()
+
+    logsetup.setup_from_args(args)
+    if args.workers > 1:
+        run_sharded(args)
+    else:
+        start_http_server(args.metrics_port)
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(my_app(args, record=args.record))
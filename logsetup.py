@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+# Levels of noisy components unless configured otherwise
+DEFAULT_LEVELS = {'websockets': 'CRITICAL'}
+# Max records per second of per-frame loggers unless configured otherwise
+DEFAULT_RATES = {'stegos.frames': 100.0}
+
+TEXT_FORMAT = '%(asctime)s %(message)s'
+# LogRecord attributes which aren't extra fields
+RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def record_fields(record):
+    """ Fields passed with extra={...} (and 'suppressed' of RateLimitFilter) """
+    return {k: v for k, v in vars(record).items() if k not in RECORD_ATTRS}
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        """ Same lines as basicConfig(format=TEXT_FORMAT), extra fields are
+        left out (messages already contain them) except 'suppressed'.
+        """
+        super().__init__(TEXT_FORMAT)
+
+    def format(self, record):
+        text = super().format(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            text += f" ({suppressed} more suppressed)"
+        return text
+
+
+class KeyValueFormatter(logging.Formatter):
+    def format(self, record):
+        fields = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': json.dumps(record.getMessage()),
+        }
+        fields.update(record_fields(record))
+        text = ' '.join(f"{k}={v}" for k, v in fields.items())
+        if record.exc_info:
+            text += '\n' + self.formatException(record.exc_info)
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        fields = {
+            'ts': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        fields.update(record_fields(record))
+        if record.exc_info:
+            fields['exc'] = self.formatException(record.exc_info)
+        return json.dumps(fields, default=str)
+
+
+FORMATTERS = {
+    'text': TextFormatter,
+    'kv': KeyValueFormatter,
+    'json': JsonFormatter,
+}
+
+
+class RateLimitFilter(logging.Filter):
+    def __init__(self, rates):
+        """ Token bucket per logger
+        Attributes:
+            rates: logger name (prefix) -> max records per second
+        The number of records dropped since the last one let through is
+        added to it as the 'suppressed' field.
+        """
+        super().__init__()
+        self.rates = rates
+        self.buckets = {}
+
+    def rate(self, name):
+        while name:
+            if name in self.rates:
+                return self.rates[name]
+            name = name.rpartition('.')[0]
+        return None
+
+    def filter(self, record):
+        bucket = self.buckets.get(record.name)
+        if bucket is None:
+            rate = self.rate(record.name)
+            # [rate, tokens, updated, suppressed]
+            bucket = self.buckets[record.name] = None if rate is None else [rate, rate, time.monotonic(), 0]
+        if bucket is None:
+            return True
+        now = time.monotonic()
+        bucket[1] = min(bucket[0], bucket[1] + (now - bucket[2]) * bucket[0])
+        bucket[2] = now
+        if bucket[1] < 1.0:
+            bucket[3] += 1
+            return False
+        bucket[1] -= 1.0
+        if bucket[3]:
+            record.suppressed = bucket[3]
+            bucket[3] = 0
+        return True
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """ QueueHandler which leaves formatting to the writer thread """
+
+    def prepare(self, record):
+        return record
+
+
+def parse_pairs(spec, convert=str):
+    """ 'a=1,b.c=2' -> {'a': convert('1'), 'b.c': convert('2')} """
+    pairs = {}
+    for item in (spec or '').split(','):
+        if item.strip():
+            name, value = item.split('=', 1)
+            pairs[name.strip()] = convert(value.strip())
+    return pairs
+
+
+def setup_logging(level='INFO', levels=None, fmt='text', path=None, max_bytes=100 * 1024 * 1024,
+                  backup_count=5, rates=None, console=True):
+    """ Log through a queue, formatting and I/O happen in a background thread
+    Attributes:
+        level: root level
+        levels: logger name -> level, e.g. {'stegos.frames': 'WARNING'}
+        fmt: 'text', 'kv' (key=value) or 'json'
+        path (String): also write to this rotating file
+        rates: logger name (prefix) -> max records per second
+    Returns the QueueListener, which is stopped (and flushed) at exit.
+    """
+    formatter = FORMATTERS[fmt]()
+    handlers = []
+    if console:
+        handlers.append(logging.StreamHandler(sys.stderr))
+    if path is not None:
+        handlers.append(logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    handler = DeferredQueueHandler(records)
+    rates = DEFAULT_RATES if rates is None else rates
+    if rates:
+        handler.addFilter(RateLimitFilter(rates))
+    # Records don't use caller/process info, skip collecting it (see
+    # "Optimization" in the logging HOWTO)
+    logging._srcfile = None
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+    for name, component_level in dict(DEFAULT_LEVELS, **(levels or {})).items():
+        logging.getLogger(name).setLevel(component_level)
+
+    listener = logging.handlers.QueueListener(records, *handlers)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def add_arguments(parser, level='INFO', path=None):
+    parser.add_argument('--log-level', default=level, help="root log level")
+    parser.add_argument('--log-levels', default=None,
+                        help="per-component levels, e.g. stegos.frames=WARNING,stegos.tx=DEBUG")
+    parser.add_argument('--log-format', default='text', choices=list(FORMATTERS), help="log record format")
+    parser.add_argument('--log-file', default=path, help="also log to this rotating file")
+    parser.add_argument('--log-rates', default=None,
+                        help=f"max records/sec per component, default "
+                             f"{','.join(f'{k}={v:g}' for k, v in DEFAULT_RATES.items())}")
+
+
+def setup_from_args(args):
+    rates = None if args.log_rates is None else parse_pairs(args.log_rates, float)
+    return setup_logging(args.log_level, parse_pairs(args.log_levels), args.log_format, args.log_file, rates=rates)
@@ -1,92 +1,166 @@
 #!/usr/bin/env python3
 
+import argparse
 import asyncio
-import json
+import concurrency
 import logging
+import logsetup
+import shards
 import stegos
 import sys
 import websockets
 
-from logging.handlers import RotatingFileHandler
+from planner import PaymentPlanner
+from pool import NodeUnavailable, StegosPool
 from prometheus_client import start_http_server
+from runrecord import RunRecorder
 
+# Payment records of the run, analyze with runrecord.py
+RECORD_FILE = 'megacannon.ndjson'
+# Size of outputs accounts are split into for parallel payments (tokens)
+SPLIT_AMOUNT = 1.0
 
-def load_nodes(path):
-    f = open(path, "r")
-    encoded = f.read()
-    return json.loads(encoded)
 
-
-async def client_from_node(node):
-    client = stegos.StegosClient(node_id=node['node_id'],
-                                 uri=node['uri'],
-                                 accounts=node['accounts'],
-                                 master_key=node['key_password'],
-                                 api_key=node['api_token'])
-
-    await client.connect()
-    await client.subscribe_status()
-    return client
+async def acquire(pool, node_id):
+    """ Connection to node_id, waiting while the node is unreachable """
+    while True:
+        try:
+            return await pool.acquire(node_id)
+        except NodeUnavailable as e:
+            print(f"Node: {e}. Retrying in 5 secs...")
+            await asyncio.sleep(5)
 
 
-async def loop_payment(client, source, target, start_amount):
+async def loop_payment(pool, node_id, source, target, start_amount, planner=None):
+    client = await acquire(pool, node_id)
     amount = start_amount
     while True:
         try:
-            if await client.secure_payment_with_confirmation(source, target, amount):
-                amount = amount + 0.001
+            if planner is None:
+                result = await client.secure_payment_with_confirmation(source, target, amount)
+                ok = result['success']
+                # With an adaptive limit the node is backed off by the limit
+                pause = not ok and (client.limiter is None or result.get('message') == "Balance is too low")
             else:
+                # The planner queues payments until outputs are free, so
+                # only an account which ran out of money needs a pause
+                planner.watch(client)
+                result = await planner.pay(client, source, target, amount, secure=True)
+                ok = result['success']
+                pause = result.get('message') == "Balance is too low"
+            if ok:
+                amount = amount + 0.001
+            elif pause:
                 # sleep 5 sec after the error
                 await asyncio.sleep(5)
-        except websockets.exceptions.ConnectionClosedError:
+            if pool.is_retired(client):
+                # Dropped by a health check, move to a healthy connection
+                pool.release(client)
+                client = await acquire(pool, node_id)
+        except (websockets.exceptions.ConnectionClosed, ConnectionError):
             print(
                 f"Node: {client.node_id} closed connection. Re-connecting....")
-            await client.connect()
-            await client.wait_sync()
+            # The pool replaces the dead connection with a synchronized one
+            pool.release(client)
+            client = await acquire(pool, node_id)
         except Exception as e:
             print(f"Node: {client.node_id} failed: {e}. Terminating...")
             sys.exit(1)
 
 
-async def my_app(nodes):
+def cannon_clients(nodes):
+    """ Every account pays to the next account of the same node """
     clients = []
     for n in range(0, len(nodes)):
         accounts = list(nodes[n]['accounts'].keys())
         accounts.sort()
         for i in range(0, len(accounts)):
             client = {
-                "socket": await client_from_node(nodes[n]),
+                "node_id": nodes[n]['node_id'],
                 "source": accounts[i],
                 "dest": nodes[n]['accounts'][accounts[(i+1) % len(accounts)]],
             }
             clients.append(client)
-            print(
-                f"clients lients[{i}]: source={client['source']}, dest={client['dest']}")
+    return clients
+
+
+async def my_app(nodes, clients, record=RECORD_FILE, parallel=1, controller=None):
+    recorder = RunRecorder(record)
+    recorder.start()
+    # Accounts of a node share a few multiplexed connections from the pool
+    node_ids = set(c['node_id'] for c in clients)
+    pool = StegosPool([n for n in nodes if n['node_id'] in node_ids], recorder=recorder, controller=controller)
+    await pool.start()
+    for i, client in enumerate(clients):
+        print(f"clients[{i}]: source={client['source']}, dest={client['dest']}")
 
     for c in clients:
-        await c['socket'].wait_sync()
-        b = await c['socket'].get_balance(c['source'])
+        try:
+            async with pool.lease(c['node_id']) as socket:
+                b = await socket.get_balance(c['source'])
+        except NodeUnavailable as e:
+            # Its payment loops wait for the node
+            print(f"Node: {e}, skipping balance check of {c['source']}")
+            continue
         assert b > 0
 
-    for c in clients:
-        c['socket'].wait_sync()
-        asyncio.ensure_future(loop_payment(
-            c['socket'], c['source'], c['dest'], 0.01))
+    planner = None
+    if parallel > 1:
+        # Enough outputs per account for `parallel` payments in flight
+        planner = PaymentPlanner()
+        splits = []
+        for c in clients:
+            try:
+                client = await pool.acquire(c['node_id'], lease=False)
+            except NodeUnavailable as e:
+                print(f"Node: {e}, not splitting {c['source']}")
+                continue
+            planner.watch(client)
+            splits.append(planner.split(client, c['source'], parallel, SPLIT_AMOUNT))
+        await asyncio.gather(*splits)
+
+    tasks = [asyncio.ensure_future(loop_payment(pool, c['node_id'], c['source'], c['dest'], 0.01, planner))
+             for c in clients for _ in range(0, parallel)]
+    return pool, recorder, tasks
+
+
+async def cannon_worker(clients, index, args, stop):
+    """ One worker process of a sharded run, returns number of payments sent """
+    nodes = stegos.load_nodes(args.nodes)
+    pool, recorder, tasks = await my_app(nodes, clients, f"{RECORD_FILE}.{index}", args.parallel,
+                                         concurrency.from_args(args))
+    await stop.wait()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await pool.close()
+    await recorder.close()
+    return recorder.count
 
 
 if __name__ == '__main__':
-    start_http_server(8891)
-    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.DEBUG)
-    # add a rotating handler
-    handler = RotatingFileHandler(
-        'megacannon.log', maxBytes=100*1024*1024, backupCount=5)
-    formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    handler.setFormatter(formatter)
-    logging.getLogger('').addHandler(handler)
-    logging.getLogger('websockets').addHandler(logging.NullHandler())
-    logging.getLogger('websockets').setLevel(logging.CRITICAL)
-    nodes = load_nodes("vst.json")
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(my_app(nodes))
-    loop.run_forever()
+    parser = argparse.ArgumentParser(description="Snowball payments between accounts of every node")
+    parser.add_argument('--nodes', default="vst.json", help="nodes config file")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="worker processes, accounts are split between them (record files get .N suffix)")
+    parser.add_argument('--metrics-port', type=int, default=8891, help="Prometheus exporter port")
+    parser.add_argument('--parallel', type=int, default=1,
+                        help="payments in flight per account, accounts are split into that many outputs first")
+    concurrency.add_arguments(parser)
+    logsetup.add_arguments(parser, level='DEBUG', path='megacannon.log')
+    args = parser.parse_args()
+
+    # Console and rotating file, written from a background thread
+    logsetup.setup_from_args(args)
+    nodes = stegos.load_nodes(args.nodes)
+    clients = cannon_clients(nodes)
+    if args.workers > 1:
+        # Until Ctrl+C, then every worker stops its payments and flushes its records
+        sent = shards.run_workers(cannon_worker, shards.split(clients, args.workers), args, args.metrics_port)
+        logging.info(f"Payments sent: {sum(s or 0 for s in sent)}")
+    else:
+        start_http_server(args.metrics_port)
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(my_app(nodes, clients, parallel=args.parallel,
+                                       controller=concurrency.from_args(args)))
+        loop.run_forever()
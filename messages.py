@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+import collections.abc
+
+# Message classes by 'type', filled by @message
+MESSAGE_TYPES = {}
+
+MISSING = object()
+
+
+class MalformedMessage(Exception):
+    pass
+
+
+class Field:
+    def __init__(self, key=None, default=MISSING):
+        """ Attribute of a message read from its JSON object on access,
+        nothing is converted or copied for fields nobody reads.
+        Attributes:
+            key (String): JSON key, the attribute name by default
+            default: value when the key is absent, fields without one are required
+        """
+        self.key = key
+        self.default = default
+
+    def __set_name__(self, owner, name):
+        if self.key is None:
+            self.key = name
+
+    def __get__(self, msg, owner=None):
+        if msg is None:
+            return self
+        value = msg.data.get(self.key, self.default)
+        if value is MISSING:
+            raise MalformedMessage(f"{msg.type} without '{self.key}'")
+        return value
+
+
+class Message(collections.abc.Mapping):
+    """ Incoming message: slotted, read-only view of the parsed JSON object
+    Typed fields are attributes (msg.tx_hash), dict-style access
+    (msg['tx_hash'], msg.get(...)) keeps working for existing listeners.
+    Attributes:
+        data (dict): the parsed JSON object, shared, not copied
+        required: keys of Fields without default, checked by validate()
+    """
+    __slots__ = ('data',)
+    required = ()
+
+    id = Field(default=None)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        fields = {}
+        for klass in reversed(cls.__mro__):
+            for name, value in vars(klass).items():
+                if isinstance(value, Field):
+                    fields[name] = value
+        cls.required = tuple(f.key for f in fields.values() if f.default is MISSING)
+
+    @property
+    def type(self):
+        return self.data['type']
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.data!r})"
+
+    def validate(self):
+        """ Required keys which are missing """
+        data = self.data
+        return [key for key in self.required if key not in data]
+
+
+def message(*types):
+    """ Class decorator registering a Message class for these types """
+    def register(cls):
+        for msg_type in types:
+            MESSAGE_TYPES[msg_type] = cls
+        return cls
+    return register
+
+
+def parse(data):
+    """ Typed message of a parsed JSON object """
+    if type(data) is not dict or 'type' not in data:
+        raise MalformedMessage(f"Not a message: {data!r:.200}")
+    return MESSAGE_TYPES.get(data['type'], Message)(data)
+
+
+@message('error')
+class Error(Message):
+    __slots__ = ()
+    error = Field()
+
+
+@message('status_changed', 'status_info')
+class Status(Message):
+    __slots__ = ()
+    epoch = Field()
+    offset = Field()
+    is_synchronized = Field()
+
+
+@message('transaction_status')
+class TransactionStatus(Message):
+    __slots__ = ()
+    tx_hash = Field()
+    status = Field()
+    account_id = Field(default=None)
+
+
+@message('balance_changed', 'balance_info')
+class Balance(Message):
+    __slots__ = ()
+    available = Field()
+    balance = Field(default=None)
+    account_id = Field(default=None)
+
+
+@message('transaction_created')
+class TransactionCreated(Message):
+    __slots__ = ()
+    tx_hash = Field()
+    outputs = Field()
+    account_id = Field(default=None)
+
+
+@message('snowball_started', 'snowball_created')
+class Snowball(Message):
+    __slots__ = ()
+    account_id = Field(default=None)
+    tx_hash = Field(default=None)
+
+
+@message('accounts_info')
+class AccountsInfo(Message):
+    __slots__ = ()
+    accounts = Field()
+
+
+@message('account_info')
+class AccountInfo(Message):
+    __slots__ = ()
+    account_pkey = Field()
+
+
+@message('account_created')
+class AccountCreated(Message):
+    __slots__ = ()
+    account_id = Field()
+
+
+@message('certificate_valid')
+class CertificateValid(Message):
+    __slots__ = ()
+    epoch = Field()
+    timestamp = Field()
+    amount = Field()
+    is_final = Field()
+
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+import prometheus_client as prom
+
+# Buckets for network round-trips and transaction confirmation (seconds)
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900)
+# Buckets for per-frame CPU work (seconds)
+CODEC_BUCKETS = (.00001, .000025, .00005, .0001, .00025, .0005, .001, .0025, .01)
+
+SNOWBALL_TIMINGS = prom.Gauge(
+    'snowball_duration', 'How long transaction took', ['account'])
+SNOWBALL_COUNTS = prom.Counter('snowball_success_count',
+                               'How many successful Snowball transactions processed', ['account'])
+
+REQUEST_LATENCY = prom.Histogram('stegos_request_seconds',
+                                 'Request round-trip time by message type',
+                                 ['node', 'account', 'type'], buckets=LATENCY_BUCKETS)
+TX_PREPARED_LATENCY = prom.Histogram('stegos_tx_prepared_seconds',
+                                     'Time from transaction_created to prepared',
+                                     ['node', 'account'], buckets=LATENCY_BUCKETS)
+TX_COMMITTED_LATENCY = prom.Histogram('stegos_tx_committed_seconds',
+                                      'Time from prepared to committed',
+                                      ['node', 'account'], buckets=LATENCY_BUCKETS)
+SNOWBALL_PHASES = prom.Histogram('stegos_snowball_phase_seconds',
+                                 'Time from secure_payment request to Snowball phase',
+                                 ['node', 'account', 'phase'], buckets=LATENCY_BUCKETS)
+FAILURES = prom.Counter('stegos_failures',
+                        'Failed requests and transactions by reason',
+                        ['node', 'account', 'reason'])
+FRAMES = prom.Counter('stegos_frames', 'WebSocket frames', ['node', 'direction'])
+MESSAGES = prom.Counter('stegos_messages', 'Incoming messages dispatched, by type', ['node', 'type'])
+FRAME_BYTES = prom.Counter('stegos_frame_bytes', 'WebSocket frame bytes', ['node', 'direction'])
+CODEC_TIME = prom.Histogram('stegos_codec_seconds', 'Time spent in encrypt/decrypt of frames',
+                            ['node', 'op'], buckets=CODEC_BUCKETS)
+CONCURRENCY_LIMIT = prom.Gauge('stegos_concurrency_limit', 'Adaptive limit of payments in flight per node',
+                              ['node'], multiprocess_mode='livesum')
+PAYMENTS_IN_FLIGHT = prom.Gauge('stegos_payments_in_flight', 'Payments holding a concurrency slot',
+                                ['node'], multiprocess_mode='livesum')
+# Node health as seen by this client, the worst view of all worker processes
+NODE_HEALTH = prom.Gauge('stegos_node_health', 'Node health score, 0 unusable to 1 best node',
+                         ['node'], multiprocess_mode='livemin')
+NODE_RTT = prom.Gauge('stegos_node_rtt_seconds', 'Smoothed request round-trip time',
+                      ['node'], multiprocess_mode='livemax')
+NODE_ERROR_RATE = prom.Gauge('stegos_node_error_rate', 'Smoothed share of requests without response',
+                             ['node'], multiprocess_mode='livemax')
+NODE_LAG = prom.Gauge('stegos_node_lag_blocks', 'Blocks behind the most advanced node',
+                      ['node'], multiprocess_mode='livemax')
+
+
+class ClientMetrics:
+    def __init__(self, node_id):
+        """ Metric children of one StegosClient, resolved once instead of per frame """
+        self.node_id = node_id
+        self.frames_in = FRAMES.labels(node=node_id, direction='in')
+        self.frames_out = FRAMES.labels(node=node_id, direction='out')
+        self.bytes_in = FRAME_BYTES.labels(node=node_id, direction='in')
+        self.bytes_out = FRAME_BYTES.labels(node=node_id, direction='out')
+        self.encrypt_time = CODEC_TIME.labels(node=node_id, op='encrypt')
+        self.decrypt_time = CODEC_TIME.labels(node=node_id, op='decrypt')
+        # Children of MESSAGES by type, created on first message of the type
+        self.messages = {}
+
+    def sent(self, frame, elapsed):
+        self.frames_out.inc()
+        self.bytes_out.inc(len(frame))
+        self.encrypt_time.observe(elapsed)
+
+    def received(self, frame, elapsed):
+        self.frames_in.inc()
+        self.bytes_in.inc(len(frame))
+        self.decrypt_time.observe(elapsed)
+
+    def request(self, req, elapsed):
+        REQUEST_LATENCY.labels(node=self.node_id, account=req.get('account_id', ''),
+                               type=req['type']).observe(elapsed)
+
+    def message(self, msg_type):
+        counter = self.messages.get(msg_type)
+        if counter is None:
+            counter = self.messages[msg_type] = MESSAGES.labels(node=self.node_id, type=msg_type)
+        counter.inc()
+
+    def failure(self, account_id, reason):
+        FAILURES.labels(node=self.node_id, account=account_id or '', reason=reason).inc()
+
+    def tx_status(self, tx):
+        """ Record latency/outcome of a tracked transaction after a status update """
+        if tx.account_id is None:
+            return
+        if tx.status == 'prepared':
+            elapsed = tx.latency('prepared')
+            if elapsed is not None:
+                TX_PREPARED_LATENCY.labels(node=self.node_id, account=tx.account_id).observe(elapsed)
+        elif tx.status == 'committed':
+            elapsed = tx.latency('committed', 'prepared')
+            if elapsed is not None:
+                TX_COMMITTED_LATENCY.labels(node=self.node_id, account=tx.account_id).observe(elapsed)
+        elif tx.status in ['rejected', 'conflicted', 'rollback']:
+            self.failure(tx.account_id, tx.status)
+
+    def snowball_phase(self, account_id, phase, elapsed):
+        SNOWBALL_PHASES.labels(node=self.node_id, account=account_id, phase=phase).observe(elapsed)
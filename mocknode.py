@@ -0,0 +1,476 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import os
+import random
+import stegos
+import time
+import websockets
+
+# Default api token of mock nodes, same as in sample.json
+API_TOKEN = "NE8L/DhwVJ+dRnN1277vhQ=="
+# Initial balance of every mock account (in uSTG)
+START_BALANCE = 1_000_000 * 1_000_000
+# Outputs the initial balance is split into, so that an account can have
+# that many payments in flight (change isn't spendable before it's prepared)
+START_OUTPUTS = 100
+# Blocks kept for subscribe_chain catch-up
+HISTORY_SIZE = 10_000
+
+
+def random_hash():
+    return os.urandom(32).hex()
+
+
+class MockAccount:
+    def __init__(self, account_id, password, balance=START_BALANCE, sealed=False, outputs=START_OUTPUTS):
+        """ Account of MockNode
+        Attributes:
+            unspent: utxo -> amount of spendable outputs
+            pending: utxo -> amount of own outputs (change, self-payments) of
+                     transactions which aren't prepared yet
+        """
+        self.account_id = account_id
+        self.address = 'stt1' + os.urandom(26).hex()
+        self.password = password
+        self.sealed = sealed
+        self.unspent = {}
+        self.pending = {}
+        for n in range(0, outputs):
+            amount = balance // outputs + (balance % outputs if n == 0 else 0)
+            if amount > 0:
+                self.unspent[random_hash()] = amount
+
+    @property
+    def available(self):
+        return sum(self.unspent.values())
+
+    @property
+    def balance(self):
+        return self.available + sum(self.pending.values())
+
+    def pick(self, needed):
+        """ Inputs for needed uSTG: the smallest output covering it, else
+        the largest outputs adding up to it, None if there isn't enough.
+        """
+        outputs = sorted(self.unspent.items(), key=lambda o: o[1])
+        for utxo, amount in outputs:
+            if amount >= needed:
+                return [utxo]
+        picked = []
+        total = 0
+        for utxo, amount in reversed(outputs):
+            picked.append(utxo)
+            total += amount
+            if total >= needed:
+                return picked
+        return None
+
+
+class Session:
+    def __init__(self, node, websocket):
+        """ One client connection to MockNode """
+        self.node = node
+        self.websocket = websocket
+        self.status_subscribed = False
+        self.chain_subscribed = False
+
+    async def send(self, msg):
+        await self.websocket.send(self.node.codec.encode(stegos.json_dumps(msg)))
+
+    def notify(self, msg):
+        asyncio.ensure_future(self.send_quietly(msg))
+
+    async def send_quietly(self, msg):
+        try:
+            await self.send(msg)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+
+class MockNode:
+    def __init__(self, node_id='mock-01', api_token=API_TOKEN, password='', accounts=1, sealed=False,
+                 latency=0.0, jitter=0.0, block_interval=1.0, micro_blocks=10,
+                 fail_rate=0.0, error_rate=0.0, disconnect_rate=0.0,
+                 flood_rate=0.0, flood_type='status_changed', snowball_delay=0.5):
+        """ Stand-in for a Stegos node WebSocket API
+        Implements enough of the API for StegosClient: status, accounts,
+        balances, payments (regular and Snowball), certificates and the
+        status/chain subscriptions, using the same encrypted framing.
+        Attributes:
+            sealed (bool): accounts start sealed and need unseal, like on a real node
+            latency, jitter (float): delay before every response, seconds
+            block_interval (float): seconds between micro blocks
+            micro_blocks (int): micro blocks per epoch (then a macro block)
+            fail_rate (float): share of transactions rejected/conflicted
+            error_rate (float): share of requests answered with an error
+            disconnect_rate (float): share of requests closing the connection
+            flood_rate (float): extra `flood_type` notifications per second
+            snowball_delay (float): seconds per Snowball phase
+        """
+        self.node_id = node_id
+        self.api_token = api_token
+        self.codec = stegos.Codec(base64.b64decode(api_token))
+        self.password = password
+        self.latency = latency
+        self.jitter = jitter
+        self.block_interval = block_interval
+        self.micro_blocks = micro_blocks
+        self.fail_rate = fail_rate
+        self.error_rate = error_rate
+        self.disconnect_rate = disconnect_rate
+        self.flood_rate = flood_rate
+        self.flood_type = flood_type
+        self.snowball_delay = snowball_delay
+        self.sealed = sealed
+        self.accounts = {}
+        # address -> MockAccount, for payments between accounts of the node
+        self.addresses = {}
+        for n in range(0, accounts):
+            self.add_account(str(n + 1))
+        self.sessions = set()
+        self.epoch = 1
+        self.offset = 0
+        self.mempool = []
+        self.prepared = []
+        self.outputs = {}
+        self.history = {}
+        self.blocks = []
+        self.tasks = []
+        self.requests = 0
+
+    def add_account(self, account_id):
+        account = MockAccount(account_id, self.password, sealed=self.sealed)
+        self.accounts[account_id] = account
+        self.addresses[account.address] = account
+        return account
+
+    def config(self, uri):
+        """ Node entry in sample.json format """
+        return {
+            "uri": uri,
+            "accounts": {a.account_id: a.address for a in self.accounts.values()},
+            "key_password": self.password,
+            "api_token": self.api_token,
+            "node_id": self.node_id,
+        }
+
+    def status(self):
+        return {
+            "is_synchronized": True,
+            "epoch": self.epoch,
+            "offset": self.offset,
+            "view_change": 0,
+            "last_block_hash": self.blocks[-1]['hash'] if self.blocks else random_hash(),
+        }
+
+    async def serve(self, host='127.0.0.1', port=3145):
+        self.tasks = [asyncio.ensure_future(self.block_loop())]
+        if self.flood_rate > 0:
+            self.tasks.append(asyncio.ensure_future(self.flood_loop()))
+        return await websockets.serve(self.handler, host, port, max_size=None)
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+
+    async def handler(self, websocket, path=None):
+        session = Session(self, websocket)
+        self.sessions.add(session)
+        try:
+            async for frame in websocket:
+                msg = json.loads(self.codec.decode(frame))
+                asyncio.ensure_future(self.handle(session, msg))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            self.sessions.discard(session)
+
+    async def handle(self, session, msg):
+        self.requests += 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+        if random.random() < self.disconnect_rate:
+            await session.websocket.close()
+            return
+        if random.random() < self.error_rate:
+            resp = self.error(msg, "Injected failure")
+        else:
+            handler = getattr(self, 'on_' + msg['type'], None)
+            if handler is None:
+                resp = self.error(msg, f"Unknown request: {msg['type']}")
+            else:
+                resp = await handler(session, msg)
+        if resp is not None:
+            resp['id'] = msg['id']
+            await session.send_quietly(resp)
+
+    def error(self, msg, text):
+        return {"type": "error", "error": text}
+
+    def account(self, msg):
+        account = self.accounts.get(msg.get('account_id'))
+        if account is None:
+            return None, self.error(msg, "Account not found")
+        return account, None
+
+    async def on_status_info(self, session, msg):
+        return dict(type='status_info', **self.status())
+
+    async def on_subscribe_status(self, session, msg):
+        session.status_subscribed = True
+        session.notify(dict(type='status_changed', **self.status()))
+        return {"type": "subscribed_status"}
+
+    async def on_subscribe_chain(self, session, msg):
+        position = (msg['epoch'], msg['offset'])
+        for block in self.blocks:
+            if (block['epoch'], block.get('offset', self.micro_blocks)) >= position:
+                session.notify(block)
+        session.chain_subscribed = True
+        return {"type": "subscribed_chain", "current_epoch": self.epoch, "current_offset": self.offset}
+
+    async def on_list_accounts(self, session, msg):
+        return {"type": "accounts_info",
+                "accounts": {a.account_id: a.address for a in self.accounts.values()}}
+
+    async def on_account_info(self, session, msg):
+        account, error = self.account(msg)
+        if error:
+            return error
+        return {"type": "account_info", "account_id": account.account_id,
+                "account_pkey": account.address, "network_pkey": random_hash()}
+
+    async def on_create_account(self, session, msg):
+        account = self.add_account(str(len(self.accounts) + 1))
+        return {"type": "account_created", "account_id": account.account_id}
+
+    async def on_unseal(self, session, msg):
+        account, error = self.account(msg)
+        if error:
+            return error
+        if msg['password'] != account.password:
+            return self.error(msg, "Invalid password")
+        if not account.sealed:
+            return self.error(msg, "Already unsealed")
+        account.sealed = False
+        return {"type": "unsealed", "account_id": account.account_id}
+
+    async def on_balance_info(self, session, msg):
+        account, error = self.account(msg)
+        if error:
+            return error
+        if account.sealed:
+            return self.error(msg, "Account is sealed")
+        return {"type": "balance_info", "account_id": account.account_id,
+                "balance": account.balance, "available": account.available}
+
+    async def on_payment(self, session, msg):
+        return self.create_tx(session, msg)
+
+    async def on_secure_payment(self, session, msg):
+        account, error = self.account(msg)
+        if error:
+            return error
+        session.notify({"type": "snowball_started", "account_id": account.account_id})
+        await asyncio.sleep(self.snowball_delay)
+        tx_hash = random_hash()
+        session.notify({"type": "snowball_created", "account_id": account.account_id, "tx_hash": tx_hash})
+        await asyncio.sleep(self.snowball_delay)
+        return self.create_tx(session, msg, tx_hash)
+
+    async def on_history_info(self, session, msg):
+        account, error = self.account(msg)
+        if error:
+            return error
+        log = [dict(h, status={"status": h['status']}) for h in self.history.values()
+               if h['account_id'] == account.account_id]
+        return {"type": "history_info", "log": log[-msg.get('limit', 100):]}
+
+    async def on_validate_certificate(self, session, msg):
+        output = self.outputs.get(msg['utxo'])
+        if (output is None or output['spender'] != msg['spender']
+                or output['recipient'] != msg['recipient'] or output.get('rvalue') != msg['rvalue']):
+            return self.error(msg, "Invalid certificate")
+        if output['epoch'] is None:
+            return self.error(msg, "Output not found in blockchain")
+        return {"type": "certificate_valid", "epoch": output['epoch'], "block_hash": output['block_hash'],
+                "timestamp": output['timestamp'], "amount": output['amount'],
+                "is_final": output['epoch'] < self.epoch}
+
+    def create_tx(self, session, msg, tx_hash=None):
+        account, error = self.account(msg)
+        if error:
+            return error
+        if account.sealed:
+            return self.error(msg, "Account is sealed")
+        amount = msg['amount'] + msg.get('payment_fee', 0)
+        picked = account.pick(amount)
+        if picked is None:
+            return self.error(msg, "Not enough money")
+        inputs = {utxo: account.unspent.pop(utxo) for utxo in picked}
+        change = sum(inputs.values()) - amount
+        tx_hash = tx_hash or random_hash()
+        outputs = [
+            {"output_type": "payment", "utxo": random_hash(), "recipient": msg['recipient'],
+             "amount": msg['amount'], "rvalue": random_hash() if msg.get('with_certificate') else None,
+             "is_change": False},
+        ]
+        if change > 0:
+            outputs.append({"output_type": "payment", "utxo": random_hash(), "recipient": account.address,
+                            "amount": change, "is_change": True})
+        for o in outputs:
+            self.outputs[o['utxo']] = dict(o, spender=account.address, epoch=None, block_hash=None,
+                                           timestamp=None)
+            if o['recipient'] == account.address:
+                account.pending[o['utxo']] = o['amount']
+        tx = {"tx_hash": tx_hash, "account_id": account.account_id,
+              "amount": amount, "inputs": inputs, "outputs": outputs}
+        self.mempool.append(tx)
+        self.history[tx_hash] = {"type": "outgoing", "account_id": account.account_id,
+                                 "tx_hash": tx_hash, "status": "accepted", "timestamp": time.time()}
+        session.notify({"type": "transaction_status", "account_id": account.account_id,
+                        "tx_hash": tx_hash, "status": "accepted"})
+        self.balance_changed(account)
+        return {"type": "transaction_created", "account_id": account.account_id,
+                "tx_hash": tx_hash, "fee": msg.get('payment_fee', 0), "outputs": outputs}
+
+    def balance_changed(self, account):
+        self.notify_all({"type": "balance_changed", "account_id": account.account_id,
+                         "balance": account.balance, "available": account.available})
+
+    def notify_all(self, msg, chain=False, status=False):
+        for session in list(self.sessions):
+            if (not chain and not status) or (chain and session.chain_subscribed) \
+                    or (status and session.status_subscribed):
+                session.notify(msg)
+
+    def tx_status(self, tx, status):
+        self.history[tx['tx_hash']]['status'] = status
+        # Like account notifications of a real node, statuses go to every connection
+        self.notify_all({"type": "transaction_status", "account_id": tx['account_id'],
+                         "tx_hash": tx['tx_hash'], "status": status})
+
+    async def block_loop(self):
+        while True:
+            await asyncio.sleep(self.block_interval)
+            if self.offset + 1 >= self.micro_blocks:
+                self.macro_block()
+            else:
+                self.micro_block()
+            self.notify_all(dict(type='status_changed', **self.status()), status=True)
+
+    def micro_block(self):
+        block_hash = random_hash()
+        timestamp = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        txs, self.mempool = self.mempool, []
+        included = []
+        for tx in txs:
+            account = self.accounts[tx['account_id']]
+            if random.random() < self.fail_rate:
+                self.tx_status(tx, random.choice(['rejected', 'conflicted']))
+                account.unspent.update(tx['inputs'])
+                for o in tx['outputs']:
+                    account.pending.pop(o['utxo'], None)
+                self.balance_changed(account)
+                continue
+            for o in tx['outputs']:
+                self.outputs[o['utxo']].update(epoch=self.epoch, block_hash=block_hash, timestamp=timestamp)
+                recipient = self.addresses.get(o['recipient'])
+                if recipient is not None:
+                    recipient.pending.pop(o['utxo'], None)
+                    recipient.unspent[o['utxo']] = o['amount']
+                    if recipient is not account:
+                        self.balance_changed(recipient)
+            self.balance_changed(account)
+            self.tx_status(tx, 'prepared')
+            self.prepared.append(tx)
+            included.append({"tx_hash": tx['tx_hash'], "outputs": tx['outputs']})
+        block = {"type": "micro_block_prepared", "epoch": self.epoch, "offset": self.offset,
+                 "hash": block_hash, "timestamp": timestamp, "transactions": included}
+        self.offset += 1
+        self.add_block(block)
+
+    def macro_block(self):
+        for tx in self.prepared:
+            self.tx_status(tx, 'committed')
+        self.prepared = []
+        block = {"type": "macro_block_committed", "epoch": self.epoch, "hash": random_hash(),
+                 "timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}
+        self.epoch += 1
+        self.offset = 0
+        self.add_block(block)
+
+    def add_block(self, block):
+        self.blocks.append(block)
+        if len(self.blocks) > HISTORY_SIZE:
+            del self.blocks[0]
+        self.notify_all(block, chain=True)
+
+    async def flood_loop(self):
+        # Send in batches every 10ms so high rates don't need one timer per frame
+        batch = max(1, int(self.flood_rate / 100))
+        interval = batch / self.flood_rate
+        while True:
+            await asyncio.sleep(interval)
+            for _ in range(0, batch):
+                if self.flood_type == 'transaction_status':
+                    msg = {"type": "transaction_status", "account_id": "flood",
+                           "tx_hash": random_hash(), "status": "accepted"}
+                else:
+                    msg = dict(type=self.flood_type, **self.status())
+                self.notify_all(msg)
+
+
+async def run_nodes(args):
+    nodes = []
+    configs = []
+    for n in range(0, args.nodes):
+        node = MockNode(node_id=f"mock-{n + 1:02}", api_token=args.api_token, password=args.password,
+                        accounts=args.accounts, sealed=args.sealed, latency=args.latency, jitter=args.jitter,
+                        block_interval=args.block_interval, micro_blocks=args.micro_blocks,
+                        fail_rate=args.fail_rate, error_rate=args.error_rate,
+                        disconnect_rate=args.disconnect_rate, flood_rate=args.flood_rate,
+                        flood_type=args.flood_type, snowball_delay=args.snowball_delay)
+        port = args.port + n
+        await node.serve(args.host, port)
+        nodes.append(node)
+        configs.append(node.config(f"ws://{args.host}:{port}"))
+        logging.info(f"{node.node_id} listening on ws://{args.host}:{port}")
+    if args.config is not None:
+        with open(args.config, 'w') as f:
+            f.write(json.dumps(configs, indent=2))
+    return nodes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Mock Stegos node(s) for offline benchmarks and tests")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=3145, help="port of the first node")
+    parser.add_argument('--nodes', type=int, default=1, help="number of nodes on consecutive ports")
+    parser.add_argument('--accounts', type=int, default=1, help="accounts per node")
+    parser.add_argument('--sealed', action='store_true', help="accounts start sealed")
+    parser.add_argument('--api-token', default=API_TOKEN)
+    parser.add_argument('--password', default='', help="password of mock accounts")
+    parser.add_argument('--config', default=None, help="write nodes config (sample.json format) here")
+    parser.add_argument('--latency', type=float, default=0.0, help="response delay, seconds")
+    parser.add_argument('--jitter', type=float, default=0.0, help="random extra response delay, seconds")
+    parser.add_argument('--block-interval', type=float, default=1.0, help="seconds between micro blocks")
+    parser.add_argument('--micro-blocks', type=int, default=10, help="micro blocks per epoch")
+    parser.add_argument('--fail-rate', type=float, default=0.0, help="share of rejected/conflicted txs")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of requests failing with error")
+    parser.add_argument('--disconnect-rate', type=float, default=0.0, help="share of requests dropping connection")
+    parser.add_argument('--flood-rate', type=float, default=0.0, help="extra notifications per second")
+    parser.add_argument('--flood-type', default='status_changed',
+                        choices=['status_changed', 'transaction_status'])
+    parser.add_argument('--snowball-delay', type=float, default=0.5, help="seconds per Snowball phase")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run_nodes(args))
+    loop.run_forever()
@@ -1,39 +1,19 @@
 #!/usr/bin/env python3
 
 import asyncio
-import json
+import provision
 import stegos
 
 
-def load_nodes(path):
-    f = open(path, "r")
-    encoded = f.read()
-    return json.loads(encoded)
-
-
-async def client_from_node(node):
-    client = stegos.StegosClient(node_id=node['node_id'],
-                                 uri=node['uri'],
-                                 accounts=node['accounts'],
-                                 master_key=node['key_password'],
-                                 api_key=node['api_token'])
-
-    await client.connect()
-    await client.subscribe_status()
-    return client
-
-
 async def my_app(heap_node, nodes):
-    node01 = await client_from_node(heap_node)
+    node01 = await provision.client_from_node(heap_node)
 
     my_account = list(heap['accounts'].keys())[0]
-    print("Waiting for sync!")
-    await node01.wait_sync()
     balance = await node01.get_balance('heap')
     print(f"Node01 balance before payments: {balance}")
-    for n in nodes:
-        for id in n['accounts'].keys():
-            await node01.payment_with_confirmation(my_account, n['accounts'][id], 100_000, comment="Initial payout")
+    addresses = [n['accounts'][id] for n in nodes for id in n['accounts'].keys()]
+    failed = await provision.fund(node01, my_account, addresses, 100_000)
+    print(f"Paid to {len(addresses) - len(failed)} of {len(addresses)} accounts")
 
     balance = await node01.get_balance('heap')
     print(f"Node01 balance after payments: {balance}")
@@ -49,6 +29,6 @@ if __name__ == '__main__':
         "uri": "ws://127.0.0.1:3155",
     }
 
-    nodes = load_nodes("sample.json")
+    nodes = stegos.load_nodes("sample.json")
     loop = asyncio.get_event_loop()
     loop.run_until_complete(my_app(heap, nodes))
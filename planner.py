@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+import asyncio
+import logging
+import stegos
+import time
+
+# Output states
+CONFIRMED = 'confirmed'
+# Created by a transaction which isn't prepared yet
+PENDING = 'pending'
+# Assigned to a payment in flight
+RESERVED = 'reserved'
+
+
+class Output:
+    def __init__(self, utxo, amount, status=CONFIRMED, tx_hash=None):
+        """ Output of an account as known to the planner
+        Attributes:
+            utxo (String): output hash, 'balance:N' for funds known only from the balance
+            amount (int): uSTG
+            tx_hash (String): transaction which created a PENDING output
+        """
+        self.utxo = utxo
+        self.amount = amount
+        self.status = status
+        self.tx_hash = tx_hash
+
+
+class AccountOutputs:
+    def __init__(self, account_id, address):
+        """ Outputs of one account and payments waiting for them
+        Attributes:
+            spent: tx_hash -> outputs reserved by it, restored if it fails
+            reported: available uSTG of the last balance_changed, None before one
+        """
+        self.account_id = account_id
+        self.address = address
+        self.outputs = {}
+        self.spent = {}
+        self.reported = None
+        self.changed = asyncio.Condition()
+        self.virtual = 0
+
+    def add_balance(self, amount):
+        """ Funds whose outputs aren't known (initial or incoming balance) """
+        self.virtual += 1
+        utxo = f"balance:{self.virtual}"
+        self.outputs[utxo] = Output(utxo, amount)
+
+    def total(self):
+        return sum(o.amount for o in self.outputs.values())
+
+    def known(self):
+        """ Most the node can report without incoming funds: outputs plus
+        inputs of payments in flight, which the node restores when a payment
+        fails before settle() does.
+        """
+        return self.total() + sum(o.amount for picked in self.spent.values() for o in picked)
+
+    def reconcile(self):
+        """ Track funds the node reported beyond the known ones: incoming
+        payments, or what's left when the node spent other inputs than the
+        reserved ones. Call with changed held.
+        """
+        if self.reported is not None and self.reported > self.known():
+            self.add_balance(self.reported - self.known())
+            self.changed.notify_all()
+
+    def count(self, amount):
+        """ Confirmed outputs of at least amount uSTG """
+        return sum(1 for o in self.outputs.values() if o.status == CONFIRMED and o.amount >= amount)
+
+    def pick(self, needed):
+        """ Smallest confirmed output covering needed, else the largest
+        confirmed outputs adding up to it, None if there aren't enough.
+        """
+        confirmed = sorted((o for o in self.outputs.values() if o.status == CONFIRMED), key=lambda o: o.amount)
+        for output in confirmed:
+            if output.amount >= needed:
+                return [output]
+        picked = []
+        for output in reversed(confirmed):
+            picked.append(output)
+            if sum(o.amount for o in picked) >= needed:
+                return picked
+        return None
+
+    async def reserve(self, needed, timeout=None):
+        """ Reserve outputs for a payment, waiting for outputs of payments in
+        flight to be confirmed. None if the account can't pay needed at all.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        async with self.changed:
+            while True:
+                picked = self.pick(needed)
+                if picked is not None:
+                    for output in picked:
+                        output.status = RESERVED
+                    return picked
+                if self.total() < needed:
+                    return None
+                await asyncio.wait_for(self.changed.wait(), None if deadline is None else deadline - time.monotonic())
+
+    async def release(self, picked):
+        """ Payment wasn't created, outputs are free again """
+        async with self.changed:
+            for output in picked:
+                output.status = CONFIRMED
+            self.changed.notify_all()
+
+    def spend(self, picked, tx_hash, outputs):
+        """ Payment was created: inputs are gone, own outputs are pending """
+        self.spent[tx_hash] = picked
+        for output in picked:
+            self.outputs.pop(output.utxo, None)
+        for o in outputs or []:
+            if o['recipient'] == self.address:
+                self.outputs[o['utxo']] = Output(o['utxo'], o['amount'], PENDING, tx_hash)
+
+    async def settle(self, tx_hash, success):
+        async with self.changed:
+            picked = self.spent.pop(tx_hash, [])
+            created = [o for o in self.outputs.values() if o.tx_hash == tx_hash]
+            for output in created:
+                if success:
+                    output.status = CONFIRMED
+                    output.tx_hash = None
+                else:
+                    del self.outputs[output.utxo]
+            if not success:
+                for output in picked:
+                    output.status = CONFIRMED
+                    self.outputs[output.utxo] = output
+            self.reconcile()
+            self.changed.notify_all()
+
+
+class PaymentPlanner:
+    def __init__(self, fee=stegos.PAYMENT_FEE):
+        """ Assigns non-overlapping funds to concurrent payments of an account
+        The node picks the inputs of a transaction itself, so the planner
+        can't choose them: it admits a payment only when enough of the
+        account's confirmed outputs are not already taken by payments in
+        flight, and queues it otherwise. This keeps concurrent payments
+        from racing for the same outputs (conflicted/rejected txs).
+        Outputs come from transaction_created responses, funds the planner
+        hasn't seen outputs of (initial and incoming balance) are tracked as
+        one output per balance increase.
+        Attributes:
+            accounts: account_id -> AccountOutputs, shared by all connections
+        """
+        self.fee = fee
+        self.accounts = {}
+        self.locks = {}
+
+    async def account(self, client, account_id):
+        """ AccountOutputs of account_id, loaded from its balance on first use """
+        account = self.accounts.get(account_id)
+        if account is not None:
+            return account
+        lock = self.locks.setdefault(account_id, asyncio.Lock())
+        async with lock:
+            if account_id not in self.accounts:
+                account = AccountOutputs(account_id, client.accounts[account_id])
+                balance = await client.get_balance(account_id)
+                if balance:
+                    account.add_balance(balance)
+                self.accounts[account_id] = account
+        return self.accounts[account_id]
+
+    def watch(self, client):
+        """ Pick up incoming payments from balance_changed notifications of client """
+        client.add_listener(self.on_balance, ['balance_changed'])
+
+    def on_balance(self, msg):
+        account = self.accounts.get(msg.account_id)
+        if account is not None:
+            account.reported = msg.available
+            if account.reported > account.known():
+                asyncio.ensure_future(self.reconcile(account))
+
+    async def reconcile(self, account):
+        async with account.changed:
+            account.reconcile()
+
+    async def pay(self, client, source, address, amount, comment='', secure=False, change=0, timeout=None):
+        """ payment_with_confirmation (or secure payment) once funds are free
+        change: uSTG which must be left over in the reserved outputs
+        timeout: max seconds to wait for free outputs
+        Returns dict like payment_with_confirmation.
+        """
+        account = await self.account(client, source)
+        needed = round(amount * 1_000_000) + self.fee + change
+        try:
+            picked = await account.reserve(needed, timeout)
+        except asyncio.TimeoutError:
+            return {'success': False, 'message': "No free outputs"}
+        if picked is None:
+            return {'success': False, 'message': "Balance is too low"}
+
+        tx_hash = None
+        try:
+            if secure:
+                def on_created(created):
+                    nonlocal tx_hash
+                    # Inputs are gone as soon as the transaction is created
+                    tx_hash = created.tx_hash
+                    account.spend(picked, tx_hash, created.outputs)
+
+                result = await client.secure_payment_with_confirmation(source, address, amount, on_created=on_created)
+                if 'tx_hash' not in result:
+                    await account.release(picked)
+                    return result
+                tx_hash = result['tx_hash']
+                success = result['success']
+            else:
+                async with client.payment_slot() as sample:
+                    created = await client.create_payment(source, address, amount, comment)
+                    if not created['success']:
+                        sample.failure()
+                        await account.release(picked)
+                        return created
+                    tx_hash = created['tx_hash']
+                    account.spend(picked, tx_hash, created['outputs'])
+                    success = await client.wait_tx(tx_hash)
+                    if success:
+                        sample.success()
+                    else:
+                        sample.failure()
+                result = {'success': success, 'tx_hash': tx_hash, 'tx': created['tx']}
+                if not success:
+                    result['message'] = "Transaction failed!"
+        except BaseException:
+            # Connection lost or cancelled: free the outputs, or the account
+            # stops paying. A transaction already created counts as failed.
+            if tx_hash is None:
+                await account.release(picked)
+            else:
+                await account.settle(tx_hash, False)
+            raise
+        await account.settle(tx_hash, success)
+        return result
+
+    async def split(self, client, source, parallel, amount):
+        """ Self-payments until source has `parallel` confirmed outputs big
+        enough for a payment of amount tokens each, so that many payments
+        can be in flight without waiting for each other.
+        Returns number of such outputs.
+        """
+        account = await self.account(client, source)
+        needed = round(amount * 1_000_000) + self.fee
+        while True:
+            missing = parallel - account.count(needed)
+            # Each self-payment turns one output into two usable ones
+            splittable = account.count(2 * needed + self.fee)
+            if missing <= 0 or splittable == 0:
+                break
+            results = await asyncio.gather(*[
+                self.pay(client, source, account.address, needed / 1_000_000, comment="split", change=needed)
+                for _ in range(0, min(missing, splittable))])
+            if not any(r['success'] for r in results):
+                break
+        count = account.count(needed)
+        logging.info(f"{client.node_id}[{source}]: {count} outputs for payments of {amount}")
+        return count
+
+    async def maintain(self, client, source, parallel, amount, interval=60.0):
+        """ Run split() every interval seconds, as payments use up outputs """
+        while True:
+            await self.split(client, source, parallel, amount)
+            await asyncio.sleep(interval)
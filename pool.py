@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+import asyncio
+import contextlib
+import logging
+import os
+import stegos
+
+from capture import SessionCapture
+from health import HealthMonitor
+
+# Default number of multiplexed connections per node
+MAX_CONNECTIONS = 2
+# Leases per connection before another connection to the node is opened
+MAX_LEASES = 64
+# Seconds between health checks and how long a status_info may take
+HEALTH_INTERVAL = 30.0
+HEALTH_TIMEOUT = 10.0
+# Seconds to connect and wait for sync before a node counts as unavailable
+CONNECT_TIMEOUT = 30.0
+
+
+class NodeUnavailable(Exception):
+    pass
+
+
+class StegosPool:
+    def __init__(self, nodes, max_connections=MAX_CONNECTIONS, max_leases=MAX_LEASES,
+                 health_interval=HEALTH_INTERVAL, health_timeout=HEALTH_TIMEOUT, connect_timeout=CONNECT_TIMEOUT,
+                 debug=False, recorder=None, capture_dir=None, controller=None, health=None):
+        """ Pool of multiplexed StegosClient connections to a set of nodes
+        Attributes:
+            nodes: list of node configs in sample.json format
+            max_connections (int): max connections kept per node URI
+            max_leases (int): leases sharing one connection before opening another
+            health_interval (float): seconds between health checks
+            health_timeout (float): status_info round-trip considered dead
+            connect_timeout (float): seconds to connect and sync a new connection
+            recorder (RunRecorder): passed to every connection to record payments
+            capture_dir (String): record frames of every connection to a file here
+            controller (ConcurrencyController): adaptive payment limits, shared by connections to a node
+            health (HealthMonitor): health scores of the nodes, fed by every connection
+        A node whose connection attempt failed is unavailable: acquire()
+        raises NodeUnavailable right away until a health check reconnects
+        it in the background. A connection dropped while leased is retired:
+        it isn't handed out any more and is closed by the last release().
+        """
+        self.nodes = {node['node_id']: node for node in nodes}
+        self.max_connections = max_connections
+        self.max_leases = max_leases
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.connect_timeout = connect_timeout
+        self.debug = debug
+        self.recorder = recorder
+        self.capture_dir = capture_dir
+        self.controller = controller
+        self.health = health if health is not None else HealthMonitor()
+        self.opened = 0
+        self.connections = {node['uri']: [] for node in nodes}
+        # Connection attempt in progress per URI, shared by everyone waiting for it
+        self.opening = {}
+        # URIs whose last connection attempt failed
+        self.unavailable = set()
+        self.leases = {}
+        # Dropped connections still leased, closed when released
+        self.retired = set()
+        self.health_task = None
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        return cls(stegos.load_nodes(path), **kwargs)
+
+    async def start(self):
+        """ Open one synchronized connection per node and start health checks
+        Unreachable nodes are left to the health checks, fails if no node is reachable.
+        """
+        results = await asyncio.gather(*[self.acquire(node_id, lease=False) for node_id in self.nodes],
+                                       return_exceptions=True)
+        failed = [r for r in results if isinstance(r, Exception)]
+        for e in failed:
+            logging.info(f"Pool: {e}")
+        if self.nodes and len(failed) == len(results):
+            raise failed[0]
+        self.health_task = asyncio.ensure_future(self.health_loop())
+
+    async def close(self):
+        if self.health_task is not None:
+            self.health_task.cancel()
+            self.health_task = None
+        for task in list(self.opening.values()):
+            task.cancel()
+        self.opening.clear()
+        for clients in self.connections.values():
+            for client in clients:
+                await client.close()
+            clients.clear()
+        for client in list(self.retired):
+            await client.close()
+        self.retired.clear()
+        self.leases.clear()
+
+    async def open(self, node):
+        client = stegos.StegosClient(node_id=node['node_id'],
+                                     uri=node['uri'],
+                                     accounts=node['accounts'],
+                                     master_key=node['key_password'],
+                                     api_key=node['api_token'],
+                                     debug=self.debug)
+        client.recorder = self.recorder
+        if self.controller is not None:
+            client.limiter = self.controller.limit(node['node_id'])
+        client.health = self.health.node(node['node_id'])
+        if self.capture_dir is not None:
+            self.opened += 1
+            name = f"{node['node_id']}-{os.getpid()}-{self.opened}.cap.gz"
+            client.capture = SessionCapture(os.path.join(self.capture_dir, name))
+        try:
+            await client.connect()
+            await client.subscribe_status()
+            await client.wait_sync()
+        except BaseException:
+            await client.close()
+            raise
+        return client
+
+    async def add_connection(self, node):
+        """ Open a connection to node and add it to the pool, raises NodeUnavailable """
+        uri = node['uri']
+        try:
+            client = await asyncio.wait_for(self.open(node), self.connect_timeout)
+        except asyncio.TimeoutError:
+            reason = f"not connected and synchronized within {self.connect_timeout}s"
+        except Exception as e:
+            reason = f"connection failed: {e}"
+        else:
+            self.unavailable.discard(uri)
+            self.connections[uri].append(client)
+            self.leases[client] = 0
+            return client
+        finally:
+            self.opening.pop(uri, None)
+        self.unavailable.add(uri)
+        raise NodeUnavailable(f"{node['node_id']} {reason}")
+
+    def connecting(self, node):
+        """ Connection attempt to node, started unless one is in progress """
+        task = self.opening.get(node['uri'])
+        if task is None:
+            task = self.opening[node['uri']] = asyncio.ensure_future(self.add_connection(node))
+            # Nobody may be waiting for it (background replacement)
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return task
+
+    def pick(self, node_ids=None):
+        """ Node to send the next request to, weighted by health score """
+        return self.health.pick(self.nodes if node_ids is None else node_ids)
+
+    async def acquire(self, node_id, lease=True):
+        """ Get a live connection to node_id, least leased first
+        Call release() when done, or use `async with pool.lease(node_id)`.
+        Connections are opened in the background, a caller only waits for
+        one if the node has no live connection at all. Raises
+        NodeUnavailable if the node can't be reached.
+        """
+        node = self.nodes[node_id]
+        uri = node['uri']
+        while True:
+            clients = self.connections[uri]
+            for client in [c for c in clients if not c.is_alive()]:
+                await self.discard(uri, client)
+            client = min(clients, key=self.leases.get, default=None)
+            if client is None:
+                if uri in self.unavailable:
+                    raise NodeUnavailable(f"{node_id} is unavailable")
+                # Shielded: a cancelled caller doesn't cancel the attempt others wait for
+                await asyncio.shield(self.connecting(node))
+                continue
+            if self.leases[client] >= self.max_leases and len(clients) < self.max_connections:
+                # Busy connection: open another one, meanwhile share this one
+                self.connecting(node)
+            if lease:
+                self.leases[client] += 1
+            return client
+
+    def release(self, client):
+        if client in self.leases:
+            self.leases[client] = max(0, self.leases[client] - 1)
+            if client in self.retired and self.leases[client] == 0:
+                self.retired.discard(client)
+                del self.leases[client]
+                asyncio.ensure_future(client.close())
+
+    def is_retired(self, client):
+        """ Connection was dropped from the pool, holders should acquire another one """
+        return client in self.retired
+
+    @contextlib.asynccontextmanager
+    async def lease(self, node_id):
+        client = await self.acquire(node_id)
+        try:
+            yield client
+        finally:
+            self.release(client)
+
+    async def discard(self, uri, client):
+        if client not in self.connections[uri]:
+            return
+        logging.info(f"Pool: dropping connection to {client.node_id} ({uri})")
+        self.connections[uri].remove(client)
+        if self.leases.get(client):
+            # Not closed under its holders, release() closes it
+            self.retired.add(client)
+            return
+        self.leases.pop(client, None)
+        await client.close()
+
+    async def check(self, uri, client):
+        if client.is_alive():
+            try:
+                await asyncio.wait_for(client.get_status(), self.health_timeout)
+                return
+            except Exception as e:
+                logging.info(f"Pool: health check of {client.node_id} failed: {e}")
+                if isinstance(e, asyncio.TimeoutError):
+                    client.health.failed()
+        await self.discard(uri, client)
+
+    async def health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            checks = [self.check(uri, client)
+                      for uri, clients in self.connections.items() for client in list(clients)]
+            await asyncio.gather(*checks)
+            logging.info(f"Pool: node health {self.health.summary()}")
+            # Replace connections dropped by the checks in the background,
+            # an unreachable node doesn't hold up checks of the others
+            for node in self.nodes.values():
+                if not self.connections[node['uri']]:
+                    self.connecting(node)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import asyncio
+import logging
+import stegos
+
+# How many nodes are set up at the same time
+CONCURRENCY = 8
+# Max number of unconfirmed funding payments
+FUND_WINDOW = 16
+
+
+async def gather_limited(coros, limit=CONCURRENCY):
+    """ asyncio.gather() running at most `limit` coroutines at once """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(coro):
+        async with semaphore:
+            return await coro
+
+    return await asyncio.gather(*[run(c) for c in coros])
+
+
+async def client_from_node(node, sync=True):
+    client = stegos.StegosClient(node_id=node['node_id'],
+                                 uri=node['uri'],
+                                 accounts=node['accounts'],
+                                 master_key=node['key_password'],
+                                 api_key=node['api_token'],
+                                 debug=False)
+
+    await client.connect()
+    if sync:
+        await client.subscribe_status()
+        await client.wait_sync()
+    return client
+
+
+async def node_accounts(client):
+    """ Map account_id -> address of all accounts on the node
+    Addresses missing in list_accounts are looked up concurrently.
+    """
+    accounts = await client.list_accounts()
+    missing = [id for id, address in accounts.items() if not isinstance(address, str)]
+    addresses = await asyncio.gather(*[client.get_address(id) for id in missing])
+    accounts.update(zip(missing, addresses))
+    return accounts
+
+
+async def setup_node(node, min_accounts=0, sync=True):
+    """ Fill node['accounts'], creating accounts until there are min_accounts """
+    client = await client_from_node(node, sync)
+    try:
+        accounts = await node_accounts(client)
+        missing = max(0, min_accounts - len(accounts))
+        if missing:
+            logging.info(f"{node['node_id']}: creating {missing} accounts")
+            created = await asyncio.gather(*[client.create_account() for _ in range(0, missing)])
+            for account_info in created:
+                if account_info is None:
+                    logging.info(f"{node['node_id']}: failed to create account")
+                    continue
+                accounts[account_info['account_id']] = account_info['account_address']
+        node['accounts'].update(accounts)
+        logging.info(f"{node['node_id']} has {len(node['accounts'])} accounts")
+    finally:
+        await client.close()
+    return node
+
+
+async def setup_nodes(nodes, min_accounts=0, sync=True, concurrency=CONCURRENCY):
+    """ Run setup_node() for all nodes, `concurrency` at a time """
+    return await gather_limited([setup_node(n, min_accounts, sync) for n in nodes], concurrency)
+
+
+async def fund(client, source, addresses, amount, window=FUND_WINDOW, comment="Initial payout"):
+    """ Pay `amount` to every address with pipelined payments
+    Returns list of failed payment results.
+    """
+    failed = []
+    payments = [(address, amount) for address in addresses]
+    async for result in client.pipeline_payments(source, payments, window=window, comment=comment):
+        if not result['success']:
+            logging.info(f"Payout to {result['recipient']} failed: {result['message']}")
+            failed.append(result)
+    return failed
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import base64
+import collections
+import json
+import logging
+import os
+import stegos
+import time
+import tracemalloc
+import websockets
+
+from capture import INBOUND, read_capture
+from mocknode import API_TOKEN
+
+
+class ReplayServer:
+    def __init__(self, path, speed=1.0, api_token=API_TOKEN):
+        """ Sends inbound frames of a capture to every client that connects
+        Attributes:
+            speed (float): 1 for recorded timing, N for N times faster, 0 for max speed
+            api_token (String): key to encrypt frames with, capture is plaintext
+        Frames sent by the client are read and ignored, the connection is
+        closed after the last frame.
+        """
+        self.path = path
+        self.speed = speed
+        self.codec = stegos.codec_for(base64.b64decode(api_token))
+
+    def frames(self):
+        # Encrypted up front, so encryption cost isn't part of the replay
+        return [(t, self.codec.encode(data)) for t, direction, data in read_capture(self.path)
+                if direction == INBOUND]
+
+    async def serve(self, host='127.0.0.1', port=3145):
+        return await websockets.serve(self.handler, host, port, max_size=None)
+
+    async def handler(self, websocket, path=None):
+        frames = self.frames()
+        drain = asyncio.ensure_future(self.drain(websocket))
+        start = time.monotonic()
+        try:
+            for t, frame in frames:
+                if self.speed > 0:
+                    delay = start + t / self.speed - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                await websocket.send(frame)
+            logging.info(f"Replayed {len(frames)} frames in {time.monotonic() - start:.3f}s")
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            drain.cancel()
+            await websocket.close()
+
+    async def drain(self, websocket):
+        try:
+            async for _frame in websocket:
+                pass
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+
+async def bench(path, speed=0.0, types=None, memory=False, port=3299):
+    """ Frames/sec of a StegosClient consuming a replay
+    types: notification types a listener subscribes to, None for all
+    memory (bool): also report peak Python heap, tracing slows everything down
+    """
+    server = await ReplayServer(path, speed).serve('127.0.0.1', port)
+    client = stegos.StegosClient(uri=f"ws://127.0.0.1:{port}", api_key=API_TOKEN, debug=False,
+                                 auto_reconnect=False)
+    client.add_listener(lambda msg: None, types)
+    count = 0
+    decode = client.decode_msg
+
+    def counting_decode(frame, lazy=False):
+        nonlocal count
+        count += 1
+        return decode(frame, lazy)
+
+    client.decode_msg = counting_decode
+    if memory:
+        tracemalloc.start()
+    await client.connect()
+    start = time.perf_counter()
+    await client.reader
+    elapsed = time.perf_counter() - start
+    results = {"frames": count, "seconds": elapsed, "frames_per_sec": count / elapsed}
+    if memory:
+        results["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    await client.close()
+    server.close()
+    await server.wait_closed()
+    return results
+
+
+def info(path):
+    """ Frame counts by direction and message type """
+    counts = collections.Counter()
+    duration = 0.0
+    for t, direction, data in read_capture(path):
+        msg_type = stegos.peek_type(data) or json.loads(data).get('type')
+        counts[('in' if direction == INBOUND else 'out', msg_type)] += 1
+        duration = t
+    print(f"{path}: {sum(counts.values())} frames over {duration:.1f}s, {os.path.getsize(path)} bytes")
+    for (direction, msg_type), count in counts.most_common():
+        print(f"  {direction:>3} {msg_type}: {count}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Inspect, serve and benchmark session captures")
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve = commands.add_parser('serve', help="replay capture to clients connecting to --port")
+    serve.add_argument('file')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=3145)
+    serve.add_argument('--speed', type=float, default=1.0, help="1 for recorded timing, N for N times faster, 0 for max")
+    serve.add_argument('--api-token', default=API_TOKEN)
+    run = commands.add_parser('bench', help="measure client processing rate and memory on a replay")
+    run.add_argument('file')
+    run.add_argument('--speed', type=float, default=0.0, help="replay speed, max by default")
+    run.add_argument('--types', nargs='*', default=None, help="notification types to listen to, all by default")
+    run.add_argument('--memory', action='store_true', help="trace peak Python heap (slow)")
+    commands.add_parser('info', help="frame counts by type").add_argument('file')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+    loop = asyncio.get_event_loop()
+    if args.command == 'serve':
+        loop.run_until_complete(ReplayServer(args.file, args.speed, args.api_token).serve(args.host, args.port))
+        loop.run_forever()
+    elif args.command == 'bench':
+        print(json.dumps(loop.run_until_complete(bench(args.file, args.speed, args.types, args.memory)), indent=2))
+    elif args.command == 'info':
+        info(args.file)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import time
+
+from txtracker import SUCCESS, FAILURE
+
+# Seconds to hold a prepared payment waiting for its committed status
+COMMIT_GRACE = 120.0
+STATUSES = ['accepted', 'prepared', 'committed']
+
+
+class RunRecorder:
+    def __init__(self, path, flush_interval=1.0, commit_grace=COMMIT_GRACE):
+        """ Append-only record of every payment of a load test run
+        One JSON object per line, written by a background task, with
+        wall-clock timestamps of submission and of every tx status.
+        Attributes:
+            path (String): output file, appended to if it exists
+            flush_interval (float): seconds between writes
+            commit_grace (float): how long to wait for 'committed' after
+                                  the payment was confirmed as prepared
+            executor: single writer thread, so writes land in order and
+                      close() can wait for the last one
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.commit_grace = commit_grace
+        self.file = open(path, 'a')
+        self.pending = []
+        self.count = 0
+        self.task = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush(force=True)
+        # Writes of a cancelled flush still run in the executor
+        self.executor.shutdown(wait=True)
+        self.file.close()
+
+    def payment(self, node, account, recipient, amount, kind, submitted, tx=None, error=None):
+        """ Record one payment
+        Attributes:
+            kind (String): 'payment' or 'secure_payment'
+            submitted (float): time.time() when the request was sent
+            tx (TrackedTx): tracker entry, None if no transaction was created
+            error (String): error returned by the node instead of a transaction
+        """
+        self.count += 1
+        record = {
+            'id': self.count,
+            'node': node,
+            'account': account,
+            'recipient': recipient,
+            'amount': amount,
+            'kind': kind,
+            'submitted': submitted,
+            'tx_hash': tx and tx.tx_hash,
+            'outcome': 'error' if tx is None else None,
+            'error': error,
+        }
+        self.pending.append((record, tx, time.monotonic() + self.commit_grace))
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self, force=False):
+        now = time.monotonic()
+        ready = []
+        waiting = []
+        for record, tx, deadline in self.pending:
+            if force or tx is None or tx.status == 'committed' or tx.status in FAILURE or now >= deadline:
+                ready.append(finish(record, tx))
+            else:
+                waiting.append((record, tx, deadline))
+        self.pending = waiting
+        if ready:
+            lines = ''.join(json.dumps(record) + '\n' for record in ready)
+            # Shielded: records taken from pending are written even if the task is cancelled
+            await asyncio.shield(asyncio.get_event_loop().run_in_executor(self.executor, self.write, lines))
+
+    def write(self, lines):
+        self.file.write(lines)
+        self.file.flush()
+
+
+def finish(record, tx):
+    if tx is None:
+        return record
+    for status, ts in tx.timestamps.items():
+        # Tracker timestamps are monotonic, convert to wall clock
+        record[status] = tx.created_at + (ts - tx.created)
+    record['created'] = tx.created_at
+    if tx.status in SUCCESS or tx.status in FAILURE:
+        record['outcome'] = tx.status
+    else:
+        record['outcome'] = 'timeout'
+    return record
+
+
+def read_records(path):
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def percentiles(values, points=(50, 90, 99)):
+    values = sorted(values)
+    if not values:
+        return {p: None for p in points}
+    return {p: values[min(len(values) - 1, int(len(values) * p / 100))] for p in points}
+
+
+def fmt(value):
+    return '-' if value is None else f"{value:.3f}"
+
+
+def report(records, bucket):
+    if not records:
+        print("No records")
+        return
+    start = min(r['submitted'] for r in records)
+    end = max(r.get('committed') or r.get('prepared') or r['submitted'] for r in records)
+    ok = [r for r in records if r['outcome'] in SUCCESS]
+    print(f"Payments: {len(records)}, confirmed: {len(ok)}, duration: {end - start:.1f}s, "
+          f"confirmed/s: {len(ok) / max(end - start, 1e-9):.2f}")
+
+    print(f"\nThroughput per {bucket:.0f}s")
+    print(f"{'t':>8} {'submitted/s':>12} {'prepared/s':>12} {'failed/s':>10}")
+    buckets = {}
+    for r in records:
+        row = buckets.setdefault(int((r['submitted'] - start) // bucket), [0, 0, 0])
+        row[0] += 1
+        if r.get('prepared') is not None:
+            buckets.setdefault(int((r['prepared'] - start) // bucket), [0, 0, 0])[1] += 1
+        if r['outcome'] not in SUCCESS:
+            row[2] += 1
+    for b in range(0, max(buckets) + 1):
+        submitted, prepared, failed = buckets.get(b, [0, 0, 0])
+        print(f"{b * bucket:>8.0f} {submitted / bucket:>12.2f} {prepared / bucket:>12.2f} {failed / bucket:>10.2f}")
+
+    print("\nLatency (seconds)")
+    print(f"{'phase':>20} {'count':>8} {'p50':>8} {'p90':>8} {'p99':>8}")
+    phases = [
+        ('submit->created', 'submitted', 'created'),
+        ('created->prepared', 'created', 'prepared'),
+        ('prepared->committed', 'prepared', 'committed'),
+        ('submit->prepared', 'submitted', 'prepared'),
+    ]
+    for name, since, until in phases:
+        values = [r[until] - r[since] for r in records
+                  if r.get(since) is not None and r.get(until) is not None]
+        p = percentiles(values)
+        print(f"{name:>20} {len(values):>8} {fmt(p[50]):>8} {fmt(p[90]):>8} {fmt(p[99]):>8}")
+
+    print("\nFailures per node")
+    failures = {}
+    for r in records:
+        if r['outcome'] not in SUCCESS:
+            reason = r['error'] or r['outcome']
+            node = failures.setdefault(r['node'], {})
+            node[reason] = node.get(reason, 0) + 1
+    if not failures:
+        print("  none")
+    for node in sorted(failures):
+        total = sum(failures[node].values())
+        print(f"  {node}: {total}")
+        for reason, count in sorted(failures[node].items(), key=lambda i: -i[1]):
+            print(f"    {count:>8} {reason}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Analyze payment records of load test runs")
+    parser.add_argument('files', nargs='+', help="record files written by RunRecorder")
+    parser.add_argument('--bucket', type=float, default=10.0, help="throughput bucket in seconds")
+    args = parser.parse_args()
+    records = [r for path in args.files for r in read_records(path)]
+    report(records, args.bucket)
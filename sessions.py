@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import asyncio
+import logging
+
+# Max unseal requests in flight per client
+UNSEAL_CONCURRENCY = 32
+
+
+class SessionManager:
+    def __init__(self, client, concurrency=UNSEAL_CONCURRENCY):
+        """ Unsealed accounts of one StegosClient
+        Attributes:
+            client (StegosClient): connection the accounts are unsealed on
+            concurrency (int): max unseal requests in flight
+            unsealing: account_id -> future of the unseal in progress
+        Sealed/unsealed state is kept in client.account_state, so accounts
+        known to be unsealed are never unsealed again.
+        """
+        self.client = client
+        self.concurrency = concurrency
+        self.unsealing = {}
+
+    def is_unsealed(self, account_id):
+        state = self.client.account_state.accounts.get(account_id)
+        return state is not None and state.sealed is False
+
+    def mark_sealed(self, account_id):
+        """ Node said the account is sealed (e.g. it was restarted) """
+        self.client.account_state.set_sealed(account_id, True)
+
+    def unsealed(self):
+        return [id for id in self.client.account_state.accounts if self.is_unsealed(id)]
+
+    async def send_unseal(self, account_id):
+        """ Unseal request without waiting for sync, concurrent calls for
+        the same account share one request.
+        """
+        if self.is_unsealed(account_id):
+            return True
+        fut = self.unsealing.get(account_id)
+        if fut is None:
+            fut = self.unsealing[account_id] = asyncio.ensure_future(self.request_unseal(account_id))
+            fut.add_done_callback(lambda _f: self.unsealing.pop(account_id, None))
+        return await asyncio.shield(fut)
+
+    async def request_unseal(self, account_id):
+        client = self.client
+        req = {
+            "type": "unseal",
+            "account_id": account_id,
+            "password": client.master_key,
+            "id": client.next_id(),
+        }
+        resp = await client.request(req, accept=['unsealed'])
+        if resp.type == 'unsealed' or resp.error == 'Already unsealed':
+            client.account_state.set_sealed(account_id, False)
+            return True
+        logging.info(f"{client.node_id}[{account_id}] unseal failed: {resp.error}")
+        return False
+
+    async def unseal(self, account_id):
+        """ Unseal account and wait until the node is synchronized """
+        if self.is_unsealed(account_id):
+            return True
+        result = await self.send_unseal(account_id)
+        await self.client.wait_sync(fresh=True)
+        return result
+
+    async def unseal_all(self, account_ids):
+        """ Unseal accounts `concurrency` at a time, then wait for one sync
+        Returns dict account_id -> success.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        todo = [id for id in account_ids if not self.is_unsealed(id)]
+
+        async def run(account_id):
+            async with semaphore:
+                return await self.send_unseal(account_id)
+
+        results = dict.fromkeys(account_ids, True)
+        results.update(zip(todo, await asyncio.gather(*[run(id) for id in todo])))
+        if todo:
+            await self.client.wait_sync(fresh=True)
+            logging.info(f"{self.client.node_id}: unsealed {sum(results[id] for id in todo)}/{len(todo)} accounts")
+        return results
+
+    async def restore(self):
+        """ Unseal again what was unsealed before a reconnect, in case the
+        node was restarted in between.
+        """
+        accounts = self.unsealed()
+        if not accounts:
+            return
+        for account_id in accounts:
+            self.client.account_state[account_id].sealed = None
+        await self.unseal_all(accounts)
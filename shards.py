@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import asyncio
+import logging
+import logsetup
+import multiprocessing
+import os
+import queue
+import shutil
+import signal
+import tempfile
+
+# Set for worker processes before they import prometheus_client
+METRICS_DIR_ENV = 'PROMETHEUS_MULTIPROC_DIR'
+
+
+def split(items, workers):
+    """ Deal items round-robin into at most `workers` non-empty shards """
+    return [items[n::workers] for n in range(0, min(workers, len(items)))]
+
+
+def serve_metrics(port, path):
+    """ Single Prometheus endpoint summing the metrics of all workers """
+    from prometheus_client import CollectorRegistry, multiprocess, start_http_server
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=path)
+    start_http_server(port, registry=registry)
+
+
+def worker_main(target, shard, index, args, results):
+    if getattr(args, 'log_level', None) is not None:
+        # Rotating files can't be shared between processes
+        if args.log_file is not None:
+            args.log_file = f"{args.log_file}.{index}"
+        logsetup.setup_from_args(args)
+    else:
+        logging.basicConfig(format=f'%(asctime)s [{index}] %(message)s', level=logging.INFO)
+        logging.getLogger('websockets').setLevel(logging.CRITICAL)
+    # Ctrl+C goes to the whole process group, the parent decides what to do
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    stop = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+    try:
+        result = loop.run_until_complete(target(shard, index, args, stop))
+    except Exception:
+        logging.exception(f"Worker {index} failed")
+        result = None
+    results.put((index, result))
+
+
+def run_workers(target, shards, args, metrics_port=None):
+    """ Run `await target(shard, index, args, stop)` in one process per shard
+    Every worker has its own event loop and connections. stop is an
+    asyncio.Event set when the parent gets SIGINT/SIGTERM, target should
+    then finish in-flight work and return its (picklable) result.
+    Returns list of results by shard, None for failed workers.
+    """
+    path = tempfile.mkdtemp(prefix='stegos-metrics-')
+    os.environ[METRICS_DIR_ENV] = path
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    workers = [ctx.Process(target=worker_main, args=(target, shard, n, args, results))
+               for n, shard in enumerate(shards)]
+    if metrics_port is not None:
+        serve_metrics(metrics_port, path)
+
+    def shutdown(signum, frame):
+        logging.info(f"Stopping {len(workers)} workers")
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+
+    handlers = [(s, signal.signal(s, shutdown)) for s in (signal.SIGINT, signal.SIGTERM)]
+    collected = {}
+    try:
+        for worker in workers:
+            worker.start()
+        logging.info(f"Started {len(workers)} workers")
+        while len(collected) < len(workers):
+            try:
+                index, result = results.get(timeout=1.0)
+                collected[index] = result
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers) and results.empty():
+                    break
+        for worker in workers:
+            worker.join()
+    finally:
+        for s, handler in handlers:
+            signal.signal(s, handler)
+        del os.environ[METRICS_DIR_ENV]
+        shutil.rmtree(path, ignore_errors=True)
+    return [collected.get(n) for n in range(0, len(workers))]
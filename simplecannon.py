@@ -1,16 +1,13 @@
 #!/usr/bin/env python3
 
 import asyncio
-import json
+import itertools
 import stegos
 
 from prometheus_client import start_http_server
 
-
-def load_nodes(path):
-    f = open(path, "r")
-    encoded = f.read()
-    return json.loads(encoded)
+# Max number of unconfirmed payments per account
+WINDOW = 8
 
 
 async def client_from_node(node):
@@ -26,10 +23,10 @@ async def client_from_node(node):
 
 
 async def loop_payment(client, source, target, start_amount):
-    amount = start_amount
-    while True:
-        await client.payment_with_confirmation(source, target, amount)
-        amount = amount + 1
+    payments = ((target, amount) for amount in itertools.count(start_amount))
+    async for result in client.pipeline_payments(source, payments, window=WINDOW):
+        if not result['success']:
+            print(f"Node: {client.node_id} payment failed: {result['message']}")
 
 
 async def my_app(nodes):
@@ -52,14 +49,14 @@ async def my_app(nodes):
         assert balance > 0
 
     for c in clients:
-        c['socket'].wait_sync()
+        await c['ws_client'].wait_sync()
         asyncio.ensure_future(loop_payment(
             c['ws_client'], c['source_id'], c['dest_addr'], 10))
 
 
 if __name__ == '__main__':
     start_http_server(8890)
-    nodes = load_nodes("sample.json")
+    nodes = stegos.load_nodes("sample.json")
     loop = asyncio.get_event_loop()
     loop.run_until_complete(my_app(nodes))
     loop.run_forever()
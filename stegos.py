@@ -3,29 +3,78 @@
 import asyncio
 import base64
 import binascii
+import functools
 import json
 import logging
-import prometheus_client as prom
+import os
+import random
+import re
 import sys
 import time
 import websockets
 
+from accountstate import AccountCache
+from chainstream import ChainStream, CHAIN_TYPES, QUEUE_SIZE, BLOCK, block_position, next_position
+from concurrency import unlimited
 from Crypto.Cipher import AES
-from Crypto.Util import Counter
-from Crypto import Random
+from messages import MalformedMessage, parse
+from sessions import SessionManager
+from metrics import ClientMetrics, SNOWBALL_TIMINGS, SNOWBALL_COUNTS
+from txtracker import TxTracker, SUCCESS
+
+# Use the fastest JSON library available, json_dumps() always returns bytes
+try:
+    import orjson
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:
+    try:
+        import ujson
+
+        def json_dumps(obj):
+            return ujson.dumps(obj).encode()
+        json_loads = ujson.loads
+    except ImportError:
+        def json_dumps(obj):
+            return json.dumps(obj).encode()
+        json_loads = json.loads
 
 key_bytes = 16
 
-SNOWBALL_TIMINGS = prom.Gauge(
-    'snowball_duration', 'How long transaction took', ['account'])
-SNOWBALL_COUNTS = prom.Counter('snowball_success_count',
-                               'How many successful Snowball transactions processed', ['account'])
+# Per-component loggers, levels can be set separately (see logsetup.py)
+log = logging.getLogger('stegos')
+# Every frame sent and received when debug is on
+frame_log = logging.getLogger('stegos.frames')
+# Payments and transaction statuses
+tx_log = logging.getLogger('stegos.tx')
+
+# Fee of payments created by the client (in uSTG)
+PAYMENT_FEE = 1_000
+
+# Give up waiting for transaction status after this many seconds
+TX_TIMEOUT = 900.0
+
+# High-volume notifications dropped before JSON parsing unless a listener
+# subscribed to them. status_changed isn't here: sync tracking needs it.
+LAZY_TYPES = frozenset(CHAIN_TYPES)
+
+# Requests which are safe to send again after reconnect, others are failed
+# because there is no way to know whether the node processed them.
+REPLAYABLE = frozenset(['status_info', 'list_accounts', 'account_info', 'balance_info',
+                        'unseal', 'validate_certificate', 'subscribe_status', 'subscribe_chain'])
+
+# Reconnect backoff: first delay and upper bound in seconds
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+TYPE_RE = re.compile(rb'"type"\s*:\s*"([a-z_]+)"')
+
 
 
 class StegosClient:
     id = 1
 
-    def __init__(self, node_id='node01', uri='ws://localhost:3145', accounts={}, api_key='', master_key='', debug=True):
+    def __init__(self, node_id='node01', uri='ws://localhost:3145', accounts={}, api_key='', master_key='', debug=True, auto_reconnect=True):
         """ Create StegosClient object
         Attributes:
             node_id (String): used in the debug logging.infos
@@ -33,69 +82,406 @@ class StegosClient:
             uri (String): WebSocket endpoint to connect to
             api_key (String): Encryption key for Websocket messages
             master_key (String): node's wallets key (used to decrypt key, stored on node)
+            auto_reconnect (bool): transparently reconnect after connection loss,
+                                   restoring subscriptions and in-flight requests
         """
         self.prefix = node_id + ' (Idle)'
         self.node_id = node_id
         self.uri = uri
         self.api_key = base64.b64decode(api_key)
+        self.codec = codec_for(self.api_key)
         self.master_key = master_key
         self.accounts = accounts
         self.websocket = None
         self.debug = debug
-        self.pending_txs = {}
+        self.pending_txs = TxTracker()
+        self.metrics = ClientMetrics(node_id)
+        # Optional runrecord.RunRecorder, gets every payment made by the client
+        self.recorder = None
+        # SessionCapture (see capture.py) recording decrypted frames, if set
+        self.capture = None
+        # AdaptiveLimit of payments in flight to the node (see concurrency.py), if set
+        self.limiter = None
+        # NodeHealth of the node (see health.py), if set, gets status, round trips and failures
+        self.health = None
+        self.tx_timeout = TX_TIMEOUT
         self.balance = 0
+        self.account_state = AccountCache()
+        self.sessions = SessionManager(self)
+        self.sync_waiter = None
+        # Consumers (chain streams) which stopped the reader to catch up
+        self.paused = set()
+        self.flowing = asyncio.Event()
+        self.flowing.set()
+        # Multiplexer state: a single reader task per connection routes
+        # responses by 'id' to `requests` and everything else to `listeners`.
+        self.reader = None
+        self.connected = False
+        self.connect_lock = asyncio.Lock()
+        self.requests = {}
+        self.listeners = {}
+        self.wanted_types = set()
+        self.lazy_types = set(LAZY_TYPES)
+        self.waiters = set()
+        self.status = None
+        self.synchronized = False
+        # Client state kept up to date from incoming messages, by type
+        self.handlers = {
+            'status_changed': self.on_status,
+            'transaction_status': self.tx_update,
+            'balance_changed': self.on_balance_changed,
+            'balance_info': self.on_balance_info,
+        }
+        # Reconnect state
+        self.auto_reconnect = auto_reconnect
+        self.online = asyncio.Event()
+        self.recovery = None
+        self.status_subscribed = False
+        self.chain_position = None
+        # ChainStreams using the chain subscription, the last one closed stops it
+        self.chain_streams = set()
 
     def next_id(self):
         self.id = self.id + 1
         return int(self.id)
 
     async def connect(self):
-        backoff_timer = 5
+        attempt = 0
         while True:
             try:
                 self.websocket = await websockets.connect(self.uri, ping_timeout=None, max_size=None, max_queue=128)
                 break
             except Exception as e:
-                logging.info(
-                    F"Node: {self.node_id}, Connect Exceprion: {e}, Retrying in {backoff_timer} secs..")
+                backoff_timer = backoff_delay(attempt)
+                attempt += 1
+                log.info(
+                    F"Node: {self.node_id}, Connect Exceprion: {e}, Retrying in {backoff_timer:.1f} secs..")
                 await asyncio.sleep(backoff_timer)
-                backoff_timer = min(60, backoff_timer + 10)
+
+        if self.reader is not None:
+            self.reader.cancel()
+        self.connected = True
+        self.synchronized = False
+        self.online.set()
+        self.reader = asyncio.ensure_future(self.read_loop())
+
+    async def reconnect(self):
+        """ Re-establish dropped connection.
+        Safe to call from many coroutines at once: only the first caller
+        reconnects, the rest wait for it and return.
+        """
+        async with self.connect_lock:
+            if self.connected:
+                return
+            await self.connect()
+
+    def is_alive(self):
+        """ Connected, or reconnecting on its own after connection loss """
+        return self.connected or (self.recovery is not None and not self.recovery.done())
+
+    async def close(self):
+        self.connected = False
+        self.online.clear()
+        if self.recovery is not None:
+            self.recovery.cancel()
+            self.recovery = None
+        if self.reader is not None:
+            self.reader.cancel()
+            self.reader = None
+        if self.websocket is not None:
+            await self.websocket.close()
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
+        self.fail_pending(ConnectionError(f"{self.node_id}: client closed"))
+        # Wake up requests waiting for a reconnect, they fail
+        self.online.set()
 
     async def send_msg(self, msg):
         if self.websocket is None:
             return
-        if self.debug:
+        if self.debug and log_enabled():
             d = json.dumps(msg, indent=2)
-            logging.info(f"{self.prefix} Out: {d}")
-        await self.websocket.send(str(base64.standard_b64encode(encrypt(self.api_key, json.dumps(msg).encode())), "utf-8"))
+            frame_log.info(f"{self.prefix} Out: {d}")
+        start = time.perf_counter()
+        data = json_dumps(msg)
+        frame = self.codec.encode(data)
+        self.metrics.sent(frame, time.perf_counter() - start)
+        if self.capture is not None:
+            self.capture.outbound(data)
+        await self.websocket.send(frame)
 
     async def recv_msg(self):
         if self.websocket is None:
             return
-        resp = await self.websocket.recv()
-        resp = decrypt(self.api_key, base64.b64decode(resp))
-        resp = json.loads(resp)
-        if resp['type'] == 'balance_changed' or resp['type'] == 'balance_info':
-            self.balance = resp['available']
-
-        if self.debug:
-            if resp['type'] in ['micro_block_reverted', 'micro_block_prepared', 'macro_block_committed']:
-                logging.info(f"notification: type={resp['type']}")
+        return self.decode_msg(await self.websocket.recv())
+
+    def decode_msg(self, frame, lazy=False):
+        """ Decrypt and parse one frame into a typed Message (see messages.py)
+        lazy (bool): return None without parsing JSON for frames of
+                     `lazy_types` that no listener is interested in
+        """
+        start = time.perf_counter()
+        data = self.codec.decode(frame)
+        self.metrics.received(frame, time.perf_counter() - start)
+        if self.capture is not None:
+            self.capture.inbound(data)
+        if lazy:
+            msg_type = peek_type(data)
+            if msg_type in self.lazy_types and not self.wants(msg_type):
+                return None
+        msg = parse(json_loads(data))
+
+        if self.debug and log_enabled():
+            if msg.type in CHAIN_TYPES:
+                frame_log.info(f"notification: type={msg.type}")
+            elif msg.type == 'status_changed':
+                frame_log.info(
+                    f"{self.prefix} In: epoch:{msg.get('epoch')}, offset:{msg.get('offset')}, "
+                    f"synced:{msg.get('is_synchronized')}")
             else:
-                if resp['type'] == 'status_changed':
-                    logging.info(
-                        f"{self.prefix} In: epoch:{resp['epoch']}, offset:{resp['offset']}, synced:{resp['is_synchronized']}")
-                else:
-                    d = json.dumps(resp, indent=2)
-                    logging.info(f"{self.prefix} In: {d}")
-        return resp
+                d = json.dumps(msg.data, indent=2)
+                frame_log.info(f"{self.prefix} In: {d}")
+        return msg
 
-    async def wait_sync(self):
-        while True:
-            resp = await self.recv_msg()
-            if resp['type'] == 'status_changed' and resp['is_synchronized']:
-                logging.info(f"{self.prefix} is synchronized!")
+    async def read_loop(self):
+        """ Reader task: the only consumer of the websocket. """
+        try:
+            while True:
+                if not self.flowing.is_set():
+                    await self.flowing.wait()
+                frame = await self.websocket.recv()
+                try:
+                    msg = self.decode_msg(frame, lazy=True)
+                except (MalformedMessage, ValueError) as e:
+                    # A bad frame isn't a reason to drop the connection
+                    log.warning(f"{self.node_id}: dropping malformed frame: {e}")
+                    self.metrics.failure(None, 'malformed')
+                    continue
+                if msg is not None:
+                    self.dispatch(msg)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.info(f"{self.node_id}: connection lost: {e}")
+            if self.health is not None:
+                self.health.disconnected()
+            self.connected = False
+            self.synchronized = False
+            self.online.clear()
+            self.account_state.invalidate()
+            if not self.auto_reconnect:
+                self.fail_pending(e)
+                return
+            self.fail_unreplayable(e)
+            self.recovery = asyncio.ensure_future(self.recover())
+
+    async def recover(self):
+        """ Reconnect, restore subscriptions, replay in-flight requests and
+        re-query status of transactions we are still waiting for.
+        """
+        await self.reconnect()
+        log.info(f"{self.node_id}: reconnected, restoring session")
+        try:
+            replayed = set()
+            for _fut, _accept, req in list(self.requests.values()):
+                if req['type'] == 'subscribe_chain' and self.chain_position is not None:
+                    req['epoch'], req['offset'] = self.chain_position
+                replayed.add(req['type'])
+                await self.send_msg(req)
+            if self.status_subscribed and 'subscribe_status' not in replayed:
+                await self.subscribe_status()
+            if self.chain_position is not None and 'subscribe_chain' not in replayed:
+                await self.subscribe_chain(*self.chain_position)
+            await self.requery_txs()
+            await self.sessions.restore()
+        except Exception as e:
+            # Connection dropped again, read_loop schedules another recovery
+            log.info(f"{self.node_id}: session restore failed: {e}")
+
+    def fail_unreplayable(self, exc):
+        for req_id, (fut, _accept, req) in list(self.requests.items()):
+            if req['type'] not in REPLAYABLE:
+                del self.requests[req_id]
+                if not fut.done():
+                    fut.set_exception(exc)
+
+    def dispatch(self, msg):
+        """ Route one incoming Message, the single place every message passes.
+        The handler for its type updates client state, responses complete
+        the request with the same id, all other messages (notifications and
+        non-final responses) go to the listeners. Messages missing required
+        fields only reach the request waiting for them.
+        """
+        msg_type = msg.type
+        self.metrics.message(msg_type)
+        missing = msg.validate()
+        if missing:
+            log.warning(f"{self.node_id}: {msg_type} without {', '.join(missing)}")
+            self.metrics.failure(msg.get('account_id'), 'malformed')
+        else:
+            handler = self.handlers.get(msg_type)
+            if handler is not None:
+                handler(msg)
+
+        req_id = msg.id
+        if req_id is not None and req_id in self.requests:
+            fut, accept, _req = self.requests[req_id]
+            if accept is None or msg_type in accept or msg_type == 'error':
+                del self.requests[req_id]
+                if not fut.done():
+                    fut.set_result(msg)
+                return
+
+        if missing:
+            return
+        for callback, types in list(self.listeners.items()):
+            if types is None or msg_type in types:
+                try:
+                    callback(msg)
+                except Exception:
+                    log.exception(f"{self.node_id}: listener failed")
+
+    def on_status(self, msg):
+        self.status = msg
+        self.synchronized = msg.is_synchronized
+        if self.health is not None:
+            self.health.status(msg)
+
+    def on_balance_changed(self, msg):
+        self.balance = msg.available
+        if msg.account_id is not None:
+            self.account_state.update_balance(msg.account_id, msg, self.status and self.status.epoch)
+
+    def on_balance_info(self, msg):
+        self.balance = msg.available
+
+    def tx_update(self, msg):
+        self.tx_status(msg.tx_hash, msg.status)
+
+    def tx_status(self, tx_hash, status):
+        tx = self.pending_txs.update(tx_hash, status)
+        self.metrics.tx_status(tx)
+
+    def fail_pending(self, exc):
+        requests = self.requests
+        self.requests = {}
+        for fut, _accept, _req in requests.values():
+            if not fut.done():
+                fut.set_exception(exc)
+        for fut in list(self.waiters):
+            if not fut.done():
+                fut.set_exception(exc)
+        self.pending_txs.fail_all(exc)
+
+    def pause(self, owner):
+        """ Stop reading frames until resume(owner) """
+        self.paused.add(owner)
+        self.flowing.clear()
+
+    def resume(self, owner):
+        self.paused.discard(owner)
+        if not self.paused:
+            self.flowing.set()
+
+    def add_listener(self, callback, types=None):
+        """ Subscribe callback(msg) to incoming notifications.
+        Attributes:
+            callback: plain function, called from the reader task
+            types: iterable of message types to deliver, None for all
+        """
+        self.listeners[callback] = None if types is None else frozenset(types)
+        self.update_wanted()
+        return callback
+
+    def remove_listener(self, callback):
+        self.listeners.pop(callback, None)
+        self.update_wanted()
+
+    def update_wanted(self):
+        wanted = set()
+        for types in self.listeners.values():
+            if types is None:
+                wanted = None
                 break
+            wanted.update(types)
+        self.wanted_types = wanted
+
+    def wants(self, msg_type):
+        return self.wanted_types is None or msg_type in self.wanted_types
+
+    async def request(self, req, accept=None):
+        """ Send request and wait for the response with the same id
+        Attributes:
+            req (dict): request message, 'id' is assigned if missing
+            accept: response types completing the request (errors always do);
+                    other frames with the same id are passed to listeners
+        """
+        if self.websocket is None:
+            return None
+        if self.auto_reconnect and not self.online.is_set():
+            await self.online.wait()
+            if not self.connected:
+                raise ConnectionError(f"{self.node_id}: client closed")
+        if 'id' not in req:
+            req['id'] = self.next_id()
+        fut = asyncio.get_event_loop().create_future()
+        self.requests[req['id']] = (fut, None if accept is None else frozenset(accept), req)
+        start = time.monotonic()
+        try:
+            await self.send_msg(req)
+            resp = await fut
+        except Exception:
+            if self.health is not None:
+                self.health.failed()
+            raise
+        finally:
+            self.requests.pop(req['id'], None)
+            if fut.done() and not fut.cancelled():
+                # Retrieve the exception if send_msg() failed before awaiting fut
+                fut.exception()
+        elapsed = time.monotonic() - start
+        self.metrics.request(req, elapsed)
+        if self.health is not None:
+            self.health.request(req['type'], elapsed)
+        if resp.type == 'error':
+            self.metrics.failure(req.get('account_id'), resp.error)
+        return resp
+
+    async def wait_for(self, types, predicate=None, timeout=None):
+        """ Wait for the first notification of given types matching predicate. """
+        fut = asyncio.get_event_loop().create_future()
+
+        def on_msg(msg):
+            if not fut.done() and (predicate is None or predicate(msg)):
+                fut.set_result(msg)
+
+        self.add_listener(on_msg, types)
+        self.waiters.add(fut)
+        try:
+            return await asyncio.wait_for(fut, timeout)
+        finally:
+            self.remove_listener(on_msg)
+            self.waiters.discard(fut)
+
+    async def wait_sync(self, fresh=False):
+        """ Wait until node reports it is synchronized.
+        Attributes:
+            fresh (bool): ignore last known status and wait for the next
+                          status_changed with is_synchronized
+        """
+        if not fresh and self.synchronized:
+            return
+        # All callers share one waiter for the next sync
+        if self.sync_waiter is None or self.sync_waiter.done():
+            self.sync_waiter = asyncio.ensure_future(
+                self.wait_for(['status_changed'], lambda m: m.is_synchronized))
+            self.sync_waiter.add_done_callback(self.sync_done)
+        await asyncio.shield(self.sync_waiter)
+
+    def sync_done(self, fut):
+        if not fut.cancelled() and fut.exception() is None:
+            log.info(f"{self.prefix} is synchronized!")
 
     async def list_accounts(self):
         if self.websocket is None:
@@ -104,11 +490,9 @@ class StegosClient:
             "type": "list_accounts",
             "id": self.next_id(),
         }
-        await self.send_msg(req)
-        while True:
-            resp = await self.recv_msg()
-            if resp['type'] == 'accounts_info':
-                return resp['accounts']
+        resp = await self.request(req, accept=['accounts_info'])
+        if resp.type == 'accounts_info':
+            return resp.accounts
 
     async def get_address(self, account_id):
         if self.websocket is None:
@@ -118,11 +502,10 @@ class StegosClient:
             "account_id": account_id,
             "id": self.next_id(),
         }
-        await self.send_msg(req)
-        while True:
-            resp = await self.recv_msg()
-            if resp['type'] == 'account_info':
-                return resp['account_pkey']
+        resp = await self.request(req, accept=['account_info'])
+        if resp.type == 'account_info':
+            self.account_state.set_address(account_id, resp.account_pkey)
+            return resp.account_pkey
 
     async def create_account(self):
         if self.websocket is None:
@@ -132,12 +515,10 @@ class StegosClient:
             "password": self.master_key,
             "id": self.next_id(),
         }
-        await self.send_msg(req)
-        while True:
-            resp = await self.recv_msg()
-            if resp['type'] == 'account_created':
-                account_id = resp['account_id']
-                break
+        resp = await self.request(req, accept=['account_created'])
+        if resp.type != 'account_created':
+            return None
+        account_id = resp.account_id
 
         address = await self.get_address(account_id)
         result = {
@@ -147,184 +528,304 @@ class StegosClient:
         return result
 
     async def unseal(self, account_id):
+        """ Unseal account (skipped if known unsealed) and wait for sync """
         if self.websocket is None:
             return None
-        req = {
-            "type": "unseal",
-            "account_id": account_id,
-            "password": self.master_key,
-            "id": self.next_id(),
-        }
-        await self.send_msg(req)
-        while True:
-            resp = await self.recv_msg()
-            if resp['type'] == 'unsealed' and resp['id'] == self.id:
-                result = True
-                break
-            if resp['type'] == 'error' and resp['id'] == self.id and resp['error'] == 'Already unsealed':
-                result = True
-                break
-            if resp['type'] == 'error' and resp['id'] == self.id:
-                result = False
-                break
-
-        # Wait for account to be synced
-        await self.wait_sync()
+        return await self.sessions.unseal(account_id)
 
-        return result
+    async def unseal_all(self, account_ids):
+        """ Unseal many accounts concurrently, sharing one wait for sync """
+        if self.websocket is None:
+            return None
+        return await self.sessions.unseal_all(account_ids)
 
-    async def get_balance(self, account_id):
+    async def get_balance(self, account_id, max_age=None):
+        """ Available balance of account (in uSTG)
+        max_age: answer from the account cache if it was updated within
+                 max_age seconds, None to always ask the node
+        """
         if self.websocket is None:
             return None
+        if max_age is not None:
+            available = self.account_state.available(account_id, max_age)
+            if available is not None:
+                return available
         req = {
             "type": "balance_info",
             "account_id": account_id,
-            "id": self.next_id(),
         }
-        await self.send_msg(req)
         while True:
-            resp = await self.recv_msg()
-            if resp['type'] == 'error' and resp['id'] == self.id and resp['error'] == 'Account is sealed':
+            req['id'] = self.next_id()
+            resp = await self.request(req, accept=['balance_info'])
+            if resp.type == 'error' and resp.error == 'Account is sealed':
+                self.sessions.mark_sealed(account_id)
                 await self.unseal(account_id)
-                req['id'] = self.next_id()
-                await self.send_msg(req)
                 continue
-            if 'id' in resp.keys() and resp['id'] == self.id and 'balance_info' == resp['type']:
-                return resp['available']
+            if resp.type == 'balance_info':
+                self.account_state.update_balance(account_id, resp, self.status and self.status.epoch)
+                return resp.available
+            return None
 
-    async def payment_with_confirmation(self, source, address, amount, comment='', use_certificate=False):
+    def cached_balance(self, account_id, max_age=None):
+        """ Available balance from the cache, None unless kept fresh by notifications """
+        return self.account_state.available(account_id, max_age)
+
+    def balance_too_low(self, account_id, amount, fee=PAYMENT_FEE):
+        """ True if the cache knows account can't pay amount (tokens) plus fee """
+        available = self.account_state.available(account_id)
+        return available is not None and available < round(amount * 1_000_000) + fee
+
+    async def create_payment(self, source, address, amount, comment='', use_certificate=False):
         """
-        Create regular payment and wait for TX to be included in microblock
+        Create regular payment without waiting for confirmation
         source: account_id to be used for payment
         address: account_address of recipient
         amount: number of tokens
+        Returns dict with 'success' and either 'tx_hash'/'tx' or 'message'
         """
+        if self.balance_too_low(source, amount):
+            return {
+                "success": False,
+                "message": "Balance is too low",
+            }
         req = {
             "type": "payment",
             "account_id": source,
-            "payment_fee": 1_000,
+            "payment_fee": PAYMENT_FEE,
             "recipient": address,
-            "amount": int(amount * 1_000_000),
+            "amount": round(amount * 1_000_000),
             "comment": comment,
             "locked_timestamp": None,
             "with_certificate": use_certificate,
             "id": self.next_id(),
         }
-        await self.send_msg(req)
-        while True:
-            self.prefix = self.node_id + " (waiting for tx creation)"
-            resp = await self.recv_msg()
-            if 'id' in resp.keys() and resp['id'] == self.id:
-                if resp['type'] == 'transaction_created':
-                    tx = {}
-                    for o in resp['outputs']:
-                        if o['recipient'] == address and o.get('rvalue', '0xdeadbeef') != '0xdeadbeef':
-                            tx = {
-                                'recipient': address,
-                                'utxo': o['utxo'],
-                                'amount': o['amount'],
-                            }
-                            if use_certificate:
-                                tx['rvalue'] = o['rvalue']
-                    tx_hash = resp['tx_hash']
-                    break
-                if resp['type'] == 'error':
-                    result = {
-                        "success": False,
-                        "message": resp['error']
-                    }
-                    return result
-
-        logging.info(f"tx_hash={tx_hash}")
-        status = await self.wait_tx(tx_hash)
-        self.prefix = self.node_id + "(Idle)"
+        submitted = time.time()
+        resp = await self.request(req, accept=['transaction_created'])
+        if resp.type == 'error':
+            if self.recorder is not None:
+                self.recorder.payment(self.node_id, source, address, amount, 'payment',
+                                      submitted, error=resp.error)
+            result = {
+                "success": False,
+                "message": resp.error
+            }
+            return result
+
+        tx = {}
+        for o in resp.outputs:
+            if o['recipient'] == address and o.get('rvalue', '0xdeadbeef') != '0xdeadbeef':
+                tx = {
+                    'recipient': address,
+                    'utxo': o['utxo'],
+                    'amount': o['amount'],
+                }
+                if use_certificate:
+                    tx['rvalue'] = o['rvalue']
+        tracked = self.pending_txs.track(resp.tx_hash, source)
+        if self.recorder is not None:
+            self.recorder.payment(self.node_id, source, address, amount, 'payment', submitted, tx=tracked)
+        result = {
+            'success': True,
+            'tx_hash': resp.tx_hash,
+            'tx': tx,
+            'outputs': resp.outputs,
+        }
+        return result
+
+    async def payment_with_confirmation(self, source, address, amount, comment='', use_certificate=False):
+        """
+        Create regular payment and wait for TX to be included in microblock
+        source: account_id to be used for payment
+        address: account_address of recipient
+        amount: number of tokens
+        """
+        if self.balance_too_low(source, amount):
+            # Not the node's fault, keep it out of the adaptive limit
+            return {
+                "success": False,
+                "message": "Balance is too low",
+            }
+        async with self.payment_slot() as sample:
+            created = await self.create_payment(source, address, amount, comment, use_certificate)
+            if not created['success']:
+                sample.failure()
+                return created
+            tx_hash = created['tx_hash']
+
+            prefix = f"{self.node_id}[{source}]"
+            fields = {'node': self.node_id, 'account': source, 'tx_hash': tx_hash}
+            tx_log.info(f"{prefix} tx_hash={tx_hash}", extra=fields)
+            status = await self.wait_tx(tx_hash)
+            if status:
+                sample.success()
+            else:
+                sample.failure()
         if status:
-            logging.info(f"{self.prefix} tx: {tx_hash} included in microblock")
+            tx_log.info(f"{prefix} tx: {tx_hash} included in microblock", extra=fields)
             result = {
                 'success': True,
-                'tx': tx
+                'tx_hash': tx_hash,
+                'tx': created['tx']
             }
-            return result
         else:
-            logging.info(f"{self.prefix} tx: {tx_hash} failed")
+            tx_log.info(f"{prefix} tx: {tx_hash} failed", extra=fields)
             result = {
                 'success': False,
+                'tx_hash': tx_hash,
                 'message': "Transaction failed!",
             }
+        return result
+
+    async def pipeline_payments(self, source, payments, window=8, secure=False, comment='', use_certificate=False):
+        """
+        Send payments from one account keeping up to `window` of them in flight
+        source: account_id to be used for payments
+        payments: iterable of (address, amount) pairs, may be endless
+        window: max number of unconfirmed payments at any time
+        secure: use secure_payment (Snowball) instead of regular payment
+        Async generator, yields results of payment_with_confirmation in
+        completion order, extended with 'recipient' and 'amount'.
+        """
+        payments = iter(payments)
+        in_flight = set()
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(in_flight) < window:
+                    try:
+                        address, amount = next(payments)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    in_flight.add(asyncio.ensure_future(self.pipelined_payment(
+                        source, address, amount, secure, comment, use_certificate)))
+                if not in_flight:
+                    return
+                done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in in_flight:
+                task.cancel()
+
+    async def pipelined_payment(self, source, address, amount, secure, comment, use_certificate):
+        if secure:
+            result = await self.secure_payment_with_confirmation(source, address, amount)
+        else:
+            result = await self.payment_with_confirmation(source, address, amount, comment, use_certificate)
+        result['recipient'] = address
+        result['amount'] = amount
+        return result
 
-    async def secure_payment_with_confirmation(self, source, address, amount):
-        # if self.balance <= amount:
-        #     print(
-        #         f"{self.prefix}]{source} balance is too low: balance={self.balance}, amount={amount}")
-        #     sys.exit(-1)
+    async def secure_payment_with_confirmation(self, source, address, amount, on_created=None):
+        """ Snowball payment, waits for the transaction to be included in a microblock
+        on_created: called with the transaction_created response
+        Returns dict like payment_with_confirmation, 'success' is the
+        outcome of the transaction.
+        """
+        if self.balance_too_low(source, amount):
+            tx_log.info(
+                f"{self.node_id}[{source}] balance is too low: balance={self.cached_balance(source)}, amount={amount}")
+            return {
+                "success": False,
+                "message": "Balance is too low",
+            }
         start_time = time.monotonic()
         req = {
             "type": "secure_payment",
             "account_id": source,
-            "payment_fee": 1_000,
+            "payment_fee": PAYMENT_FEE,
             "recipient": address,
-            "amount": int(amount * 1_000_000),
+            "amount": round(amount * 1_000_000),
             "comment": "",
             "locked_timestamp": None,
             "id": self.next_id(),
         }
-        await self.send_msg(req)
-        state = 'vs req sent'
-        self.prefix = f"{self.node_id}[{source}] ({state})"
-        while True:
-            resp = await self.recv_msg()
+        prefix = f"{self.node_id}[{source}]"
+        fields = {'node': self.node_id, 'account': source}
+
+        def on_snowball(msg):
+            if msg.account_id != source:
+                return
             elapsed = time.monotonic() - start_time
-            self.prefix = f"{self.node_id}[{source}] ({state}) elapsed: {elapsed}"
-            if resp['type'] == 'snowball_started' and resp['account_id'] == source:
-                state = "vs started"
-            if resp['type'] == 'snowball_created' and resp['account_id'] == source:
-                tx_hash = resp['tx_hash']
-                state = f"vs created: {tx_hash}"
-            if resp['type'] == 'transaction_created' and resp['id'] == self.id:
-                tx_hash = resp['tx_hash']
-                state = f"tx created: {tx_hash}"
-                break
-            if resp['type'] == 'error' and resp.get('id') == self.id:
-                print(f"Error happened: error={resp['error']}")
-                return False
+            if msg.type == 'snowball_started':
+                self.metrics.snowball_phase(source, 'started', elapsed)
+                tx_log.info(f"{prefix} (vs started) elapsed: {elapsed}", extra=dict(fields, elapsed=elapsed))
+            if msg.type == 'snowball_created':
+                self.metrics.snowball_phase(source, 'created', elapsed)
+                tx_log.info(f"{prefix} (vs created: {msg.tx_hash}) elapsed: {elapsed}",
+                            extra=dict(fields, tx_hash=msg.tx_hash, elapsed=elapsed))
 
-        status = await self.wait_tx(tx_hash)
+        async with self.payment_slot() as sample:
+            self.add_listener(on_snowball, ['snowball_started', 'snowball_created'])
+            submitted = time.time()
+            try:
+                resp = await self.request(req, accept=['transaction_created'])
+            finally:
+                self.remove_listener(on_snowball)
+            if resp.type == 'error':
+                sample.failure()
+                if self.recorder is not None:
+                    self.recorder.payment(self.node_id, source, address, amount, 'secure_payment',
+                                          submitted, error=resp.error)
+                print(f"Error happened: error={resp.error}")
+                return {
+                    "success": False,
+                    "message": resp.error,
+                }
+            tx_hash = resp.tx_hash
+            tracked = self.pending_txs.track(tx_hash, source)
+            if on_created is not None:
+                on_created(resp)
+            if self.recorder is not None:
+                self.recorder.payment(self.node_id, source, address, amount, 'secure_payment', submitted,
+                                      tx=tracked)
+            self.metrics.snowball_phase(source, 'tx', time.monotonic() - start_time)
+
+            status = await self.wait_tx(tx_hash)
+            if status:
+                sample.success()
+            else:
+                sample.failure()
+        fields['tx_hash'] = tx_hash
 
         if status:
-            logging.info(
-                f"{self.prefix}[{source}] tx: {tx_hash} included in microblock")
+            tx_log.info(f"{prefix} tx: {tx_hash} included in microblock", extra=fields)
             SNOWBALL_TIMINGS.labels(account=self.accounts[source]).set(
                 time.monotonic() - start_time)
             SNOWBALL_COUNTS.labels(account=self.accounts[source]).inc()
-        else:
-            logging.info(f"{self.prefix}[{source}] tx: {tx_hash} failed")
-
-        self.prefix = self.node_id + f"[{source}]" + "(Idle)"
-        return True
-
-    async def wait_tx(self, tx_hash):
-        state = f"waiting commit: tx={tx_hash}"
-        start_time = time.monotonic()
-        while True:
-            resp = await self.recv_msg()
-            elapsed = time.monotonic() - start_time
-            self.prefix = f"{self.node_id} ({state}) elapsed: {elapsed}"
-            if resp['type'] == 'transaction_status' and resp['tx_hash'] == tx_hash:
-                if resp['status'] == 'accepted':
-                    continue
-                if resp['status'] in ['rejected', 'conflicted', 'rollback']:
-                    return False
-                if resp['status'] in ['prepared', 'committed']:
-                    return True
-                return False
+            return {
+                'success': True,
+                'tx_hash': tx_hash,
+            }
+        tx_log.info(f"{prefix} tx: {tx_hash} failed", extra=fields)
+        return {
+            'success': False,
+            'tx_hash': tx_hash,
+            'message': "Transaction failed!",
+        }
 
-            elapsed = time.monotonic() - start_time
-            # if elapsed > 900.0:         # 10 minutes
-            #     logging.error(
-            #         F"Transaction processing took too long: elapsed={elapsed}")
-            #     return False
+    def payment_slot(self):
+        """ Slot of the node's adaptive payment limit, held from payment
+        request until the transaction is confirmed or failed.
+        """
+        return unlimited() if self.limiter is None else self.limiter.slot()
 
-            logging.info(f"{self.prefix} Elapsed: {elapsed}")
+    async def wait_tx(self, tx_hash, timeout=None):
+        """ Wait until tx is prepared/committed (True) or fails (False)
+        timeout: seconds to wait, defaults to self.tx_timeout
+        """
+        if timeout is None:
+            timeout = self.tx_timeout
+        try:
+            status = await self.pending_txs.wait(tx_hash, timeout)
+        except asyncio.TimeoutError:
+            tx_log.error(
+                f"{self.node_id}: transaction processing took too long: tx={tx_hash}, timeout={timeout}")
+            tx = self.pending_txs.cancel(tx_hash)
+            self.metrics.failure(tx and tx.account_id, 'timeout')
+            return False
+        return status in SUCCESS
 
     async def validate_certificate(self, utxo, sender, recipient, rvalue):
         if self.websocket is None:
@@ -337,49 +838,40 @@ class StegosClient:
             "rvalue": rvalue,
             "id": self.next_id(),
         }
-        await self.send_msg(req)
-        while True:
-            resp = await self.recv_msg()
-            if resp['type'] == 'error' and resp['id'] == self.id:
-                resp = {
-                    "success": False,
-                    "message": resp['error']
-                }
-                return resp
-
-            if resp['type'] == 'certificate_valid' and resp['id'] == self.id:
-                resp = {
-                    "success": True,
-                    "epoch": resp['epoch'],
-                    "timestamp": resp['timestamp'],
-                    "amount": resp['amount'],
-                    "is_final": resp['is_final']
-                }
-                return resp
+        resp = await self.request(req)
+        if resp.type == 'error':
+            return {
+                "success": False,
+                "message": resp.error
+            }
 
-            if resp.get('id', None) == self.id:
-                resp = {
-                    "success": False,
-                    "message": f"Unknown response type: {resp['type']}"
-                }
-                return resp
+        if resp.type == 'certificate_valid':
+            return {
+                "success": True,
+                "epoch": resp.epoch,
+                "timestamp": resp.timestamp,
+                "amount": resp.amount,
+                "is_final": resp.is_final
+            }
+
+        return {
+            "success": False,
+            "message": f"Unknown response type: {resp.type}"
+        }
 
     async def get_status(self):
         req = {
             "type": "status_info",
             "id": self.next_id(),
         }
-        await self.send_msg(req)
-        while True:
-            resp = await self.recv_msg()
-            if resp.get('id', None) == self.id:
-                resp.pop('id', None)
-                return resp
+        resp = await self.request(req)
+        # Plain dict without the request id
+        return {k: v for k, v in resp.items() if k != 'id'}
 
-    async def subscribe_chain(self, epoch=None):
+    async def subscribe_chain(self, epoch=None, offset=0):
         if epoch is None:
             status = await self.get_status()
-            logging.info(f"status = {status}")
+            log.info(f"status = {status}")
             start_epoch = status['epoch']
         else:
             start_epoch = epoch
@@ -387,59 +879,163 @@ class StegosClient:
         req = {
             "type": "subscribe_chain",
             "epoch": start_epoch,
-            "offset": 0,
+            "offset": offset,
             "id": self.next_id()
         }
-        await self.send_msg(req)
-        while True:
-            resp = await self.recv_msg()
-            if resp.get('id', None) == self.id:
-                return
+        # Remember where the stream is, so reconnect resumes from there
+        self.chain_position = (start_epoch, offset)
+        self.add_listener(self.track_chain, CHAIN_TYPES)
+        await self.request(req)
+
+    def track_chain(self, msg):
+        epoch, _offset = block_position(msg)
+        if epoch is None:
+            return
+        self.chain_position = next_position(msg)
+
+    def stop_chain(self):
+        """ Stop following the chain subscription: chain notifications are
+        dropped unparsed again and a reconnect doesn't resubscribe. The API
+        has no unsubscribe, the node keeps sending them until then.
+        """
+        self.remove_listener(self.track_chain)
+        self.chain_position = None
+
+    def chain(self, epoch=None, offset=0, maxsize=QUEUE_SIZE, overflow=BLOCK):
+        """ Stream of chain notifications, see ChainStream:
+            async for block in client.chain(epoch=...):
+        """
+        return ChainStream(self, epoch, offset, maxsize, overflow)
 
     async def subscribe_status(self):
         req = {
             'type': 'subscribe_status',
             'id': self.next_id(),
         }
-        await self.send_msg(req)
-        while True:
-            resp = await self.recv_msg()
-            if resp.get('id', None) == self.id and resp['type'] == 'subscribed_status':
-                return
+        self.status_subscribed = True
+        await self.request(req, accept=['subscribed_status'])
 
+    async def requery_txs(self):
+        """ Ask the node about transactions still pending in the tracker.
+        Statuses delivered while we were disconnected are lost, so look
+        them up in each account's history and feed them to the tracker.
+        """
+        by_account = {}
+        for tx in list(self.pending_txs.pending.values()):
+            if tx.account_id is not None:
+                by_account.setdefault(tx.account_id, []).append(tx)
+        for account_id, txs in by_account.items():
+            since = min(tx.created_at for tx in txs)
+            req = {
+                "type": "history_info",
+                "account_id": account_id,
+                "starting_from": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(since - 60)),
+                "limit": max(100, 2 * len(txs)),
+                "id": self.next_id(),
+            }
+            resp = await self.request(req)
+            if resp.type == 'error':
+                tx_log.info(f"{self.node_id}[{account_id}]: can't re-query txs: {resp.error}")
+                continue
+            for tx_hash, status in history_statuses(resp.data):
+                if tx_hash in self.pending_txs.pending:
+                    self.tx_status(tx_hash, status)
 
-def encrypt(key, plaintext):
-    assert len(key) == key_bytes
 
-    # Choose a random, 16-byte IV.
-    iv = Random.new().read(AES.block_size)
+def load_nodes(path):
+    """ Load list of node configs (see sample.json) """
+    with open(path, "r") as f:
+        return json.load(f)
 
-    # Convert the IV to a Python integer.
-    iv_int = int(binascii.hexlify(iv), 16)
 
-    # Create a new Counter object with IV = iv_int.
-    ctr = Counter.new(AES.block_size * 8, initial_value=iv_int)
+def backoff_delay(attempt):
+    """ Jittered exponential backoff: random in [d/2, d], d = base * 2^attempt """
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** min(attempt, 16))
+    return random.uniform(delay / 2, delay)
 
-    # Create AES-CTR cipher.
-    aes = AES.new(key, AES.MODE_CTR, counter=ctr)
 
-    # Encrypt and return IV and ciphertext.
-    ciphertext = aes.encrypt(plaintext)
-    return iv+ciphertext
+def history_statuses(obj):
+    """ Yield (tx_hash, status) of all transactions found in history_info """
+    if isinstance(obj, dict):
+        status = obj.get('status')
+        if isinstance(status, dict):
+            status = status.get('status')
+        if 'tx_hash' in obj and isinstance(status, str):
+            yield obj['tx_hash'], status
+        values = obj.values()
+    elif isinstance(obj, list):
+        values = obj
+    else:
+        return
+    for value in values:
+        yield from history_statuses(value)
 
 
-def decrypt(key, ciphertext):
-    assert len(key) == key_bytes
+def peek_type(data):
+    """ Cheap lookup of the message type without parsing the whole frame """
+    match = TYPE_RE.search(data)
+    if match is None:
+        return None
+    return match.group(1).decode()
+
+
+def log_enabled():
+    return frame_log.isEnabledFor(logging.INFO)
 
-    # Convert the IV to a Python integer.
-    iv_int = int(binascii.hexlify(ciphertext[:16]), 16)
 
-    # Create a new Counter object with IV = iv_int.
-    ctr = Counter.new(AES.block_size * 8, initial_value=iv_int)
+class Codec:
+    # How many random bytes to fetch from the OS at once for IVs
+    iv_pool_size = 4096
+
+    def __init__(self, key):
+        """ AES-CTR + base64 framing of WebSocket messages for one api key
+        Attributes:
+            key (bytes): decoded api key
+        """
+        self.key = key
+        self.iv_pool = b''
+        self.iv_offset = 0
 
-    # Create AES-CTR cipher.
-    aes = AES.new(key, AES.MODE_CTR, counter=ctr)
+    def next_iv(self):
+        # One os.urandom() call per iv_pool_size / 16 messages instead of a
+        # new RNG object per message.
+        if self.iv_offset >= len(self.iv_pool):
+            self.iv_pool = os.urandom(self.iv_pool_size)
+            self.iv_offset = 0
+        iv = self.iv_pool[self.iv_offset:self.iv_offset + AES.block_size]
+        self.iv_offset += AES.block_size
+        return iv
 
-    # Decrypt and return the plaintext.
-    plaintext = aes.decrypt(ciphertext[16:])
-    return plaintext
+    def encrypt(self, plaintext):
+        assert len(self.key) == key_bytes
+        iv = self.next_iv()
+        # Full 16-byte IV is the initial counter block, same as Counter.new(128, initial_value=iv)
+        aes = AES.new(self.key, AES.MODE_CTR, nonce=b'', initial_value=iv)
+        return iv + aes.encrypt(plaintext)
+
+    def decrypt(self, ciphertext):
+        assert len(self.key) == key_bytes
+        data = memoryview(ciphertext)
+        aes = AES.new(self.key, AES.MODE_CTR, nonce=b'', initial_value=data[:AES.block_size])
+        return aes.decrypt(data[AES.block_size:])
+
+    def encode(self, plaintext):
+        """ Encrypt bytes into a WebSocket text frame """
+        return binascii.b2a_base64(self.encrypt(plaintext), newline=False).decode('ascii')
+
+    def decode(self, frame):
+        """ Decrypt WebSocket text frame into bytes """
+        return self.decrypt(binascii.a2b_base64(frame))
+
+
+@functools.lru_cache(maxsize=None)
+def codec_for(key):
+    return Codec(key)
+
+
+def encrypt(key, plaintext):
+    return codec_for(key).encrypt(plaintext)
+
+
+def decrypt(key, ciphertext):
+    return codec_for(key).decrypt(ciphertext)
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+""" StegosClient against MockNode: multiplexer, reconnect, chain streams and
+the chain index. Run with `python -m pytest -q`.
+"""
+
+import asyncio
+import contextlib
+
+import pytest
+import websockets
+
+import chainstream
+import messages
+import stegos
+
+from indexer import ChainIndex
+from mocknode import MockNode
+from planner import PaymentPlanner
+from pool import StegosPool
+
+# Max seconds of a test
+TIMEOUT = 20.0
+
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, TIMEOUT))
+
+
+@contextlib.asynccontextmanager
+async def mock_client(**kwargs):
+    """ Synchronized client of a MockNode on a free port, yields (node, client),
+    node.server is the WebSocket server
+    """
+    kwargs.setdefault('block_interval', 0.05)
+    node = MockNode(**kwargs)
+    server = node.server = await node.serve('127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    cfg = node.config(f"ws://127.0.0.1:{port}")
+    client = stegos.StegosClient(node_id=node.node_id, uri=cfg['uri'], accounts=cfg['accounts'],
+                                 master_key=cfg['key_password'], api_key=cfg['api_token'], debug=False)
+    try:
+        await client.connect()
+        await client.subscribe_status()
+        await client.wait_sync()
+        yield node, client
+    finally:
+        await client.close()
+        node.stop()
+        node.server.close()
+        await node.server.wait_closed()
+
+
+async def drop_connections(node):
+    """ Close all connections on the node side """
+    for session in list(node.sessions):
+        await session.websocket.close()
+
+
+def test_concurrent_requests_get_their_own_responses():
+    async def main():
+        # Jitter reorders responses
+        async with mock_client(accounts=3, latency=0.01, jitter=0.02) as (node, client):
+            node.accounts['2'].unspent.popitem()
+            account_ids = ['1', '2', '3'] * 10
+            balances = await asyncio.gather(*[client.get_balance(a) for a in account_ids])
+            assert balances == [node.accounts[a].available for a in account_ids]
+            assert balances[1] < balances[0]
+            assert client.requests == {}
+    run(main())
+
+
+def test_listeners_get_only_their_types():
+    async def main():
+        async with mock_client(accounts=2) as (node, client):
+            received = []
+            client.add_listener(received.append, ['balance_changed'])
+            result = await client.payment_with_confirmation('1', client.accounts['2'], 1.0)
+            assert result['success']
+            assert received
+            assert all(msg.type == 'balance_changed' for msg in received)
+    run(main())
+
+
+def test_malformed_message_skips_listeners():
+    async def main():
+        async with mock_client() as (node, client):
+            received = []
+            client.add_listener(received.append)
+            client.dispatch(messages.parse({'type': 'transaction_status', 'status': 'prepared'}))
+            assert received == []
+            assert client.is_alive()
+    run(main())
+
+
+def test_reconnect_restores_session(monkeypatch):
+    monkeypatch.setattr(stegos, 'BACKOFF_BASE', 0.05)
+
+    async def main():
+        # No macro block, its committed notification would confirm the payment too
+        async with mock_client(accounts=2, sealed=True, micro_blocks=1000) as (node, client):
+            assert await client.unseal('1')
+            statuses = []
+            client.add_listener(statuses.append, ['transaction_status'])
+            created = await client.create_payment('1', client.accounts['2'], 1.0)
+            tx_hash = created['tx_hash']
+            # Node restart: the transaction gets into a block while the
+            # client can't hear about it, and accounts are sealed again
+            node.server.close()
+            await node.server.wait_closed()
+            while node.history[tx_hash]['status'] == 'accepted':
+                await asyncio.sleep(0.01)
+            for account in node.accounts.values():
+                account.sealed = True
+            port = int(client.uri.rsplit(':', 1)[1])
+            node.server = await websockets.serve(node.handler, '127.0.0.1', port)
+            # Status of the transaction only comes from the history re-query
+            assert await client.wait_tx(tx_hash, timeout=5.0)
+            assert [msg.status for msg in statuses if msg.tx_hash == tx_hash] == ['accepted']
+            await client.recovery
+            assert not node.accounts['1'].sealed
+            assert node.accounts['2'].sealed
+            assert await client.get_balance('1') == node.accounts['1'].available
+    run(main())
+
+
+def test_pool_keeps_dropped_connection_for_its_holders():
+    async def main():
+        async with mock_client(accounts=2, snowball_delay=0.01) as (node, client):
+            pool = StegosPool([node.config(client.uri)])
+            await pool.start()
+            try:
+                leased = await pool.acquire(node.node_id)
+                # Failed health check while the connection is leased
+                await pool.discard(client.uri, leased)
+                assert pool.is_retired(leased)
+                result = await leased.secure_payment_with_confirmation('1', client.accounts['2'], 1.0)
+                assert result['success']
+                other = await pool.acquire(node.node_id)
+                assert other is not leased
+                pool.release(leased)
+                await asyncio.sleep(0.1)
+                assert not leased.is_alive()
+                pool.release(other)
+            finally:
+                await pool.close()
+    run(main())
+
+
+def test_chain_stream_revert():
+    async def main():
+        async with mock_client(micro_blocks=5) as (node, client):
+            stream = client.chain(maxsize=100)
+            block = await stream.__anext__()
+            while block['type'] != 'micro_block_prepared':
+                block = await stream.__anext__()
+            # Hold further frames, so the queue only changes by the reverts below
+            client.pause('test')
+            await asyncio.sleep(0.2)
+            # Blocks not consumed yet disappear without notice
+            epoch, offset = stream.position
+            client.dispatch(messages.parse({'type': 'micro_block_reverted', 'epoch': epoch, 'offset': offset}))
+            assert all(chainstream.block_key(b) < (epoch, offset) for b in stream.queue)
+            # A consumed block is reverted with a notification
+            epoch, offset = chainstream.block_position(block)
+            client.dispatch(messages.parse({'type': 'micro_block_reverted', 'epoch': epoch, 'offset': offset}))
+            reverted = await stream.__anext__()
+            assert reverted['type'] == 'micro_block_reverted'
+            assert chainstream.block_position(reverted) == (epoch, offset)
+            client.resume('test')
+            stream.close()
+    run(main())
+
+
+def test_chain_stream_overflow():
+    async def main():
+        async with mock_client(micro_blocks=5) as (node, client):
+            await asyncio.sleep(0.5)
+            # Catch-up from epoch 0 is more than the queue holds
+            stream = client.chain(epoch=0, maxsize=2, overflow=chainstream.ERROR)
+            await stream.start()
+            await asyncio.sleep(0.2)
+            with pytest.raises(chainstream.ChainOverflow):
+                async for _block in stream:
+                    await asyncio.sleep(0.1)
+            stream = client.chain(epoch=0, maxsize=2, overflow=chainstream.DROP_OLDEST)
+            await stream.start()
+            await asyncio.sleep(0.2)
+            assert stream.dropped > 0
+            assert len(stream.queue) == 2
+            stream.close()
+    run(main())
+
+
+def test_chain_stream_close_stops_tracking():
+    async def main():
+        async with mock_client() as (node, client):
+            async with client.chain() as stream:
+                await stream.__anext__()
+            assert client.chain_position is None
+            assert not client.wants('micro_block_prepared')
+    run(main())
+
+
+def test_mock_outputs_add_up_to_balance():
+    async def main():
+        async with mock_client(accounts=2, fail_rate=0.5) as (node, client):
+            account = node.accounts['1']
+            start = account.balance
+            results = await asyncio.gather(*[client.payment_with_confirmation('1', client.accounts['2'], 1.0)
+                                             for _ in range(0, 10)])
+            paid = sum(1 for r in results if r['success'])
+            assert account.balance == start - paid * (1_000_000 + stegos.PAYMENT_FEE)
+            assert node.accounts['2'].balance == start + paid * 1_000_000
+    run(main())
+
+
+def test_planner_tracks_node_balance():
+    async def main():
+        async with mock_client(accounts=2, fail_rate=0.3) as (node, client):
+            planner = PaymentPlanner()
+            planner.watch(client)
+            await planner.split(client, '1', 8, 1.0)
+            await asyncio.gather(*[planner.pay(client, '1', client.accounts['2'], 1.0) for _ in range(0, 8)])
+            await asyncio.sleep(0.2)
+            assert planner.accounts['1'].total() == node.accounts['1'].available
+    run(main())
+
+
+def test_planner_frees_outputs_when_payment_raises():
+    async def main():
+        async with mock_client(accounts=2) as (node, client):
+            planner = PaymentPlanner()
+            create_payment = client.create_payment
+
+            async def lost(*args, **kwargs):
+                client.create_payment = create_payment
+                raise ConnectionError("connection lost")
+
+            client.create_payment = lost
+            with pytest.raises(ConnectionError):
+                await planner.pay(client, '1', client.accounts['2'], 1.0)
+            result = await planner.pay(client, '1', client.accounts['2'], 1.0, timeout=5.0)
+            assert result['success']
+    run(main())
+
+
+def micro_block(epoch, offset, txs):
+    return {'type': 'micro_block_prepared', 'epoch': epoch, 'offset': offset, 'hash': f"b{epoch}.{offset}",
+            'transactions': txs}
+
+
+def test_chain_index_revert(tmp_path):
+    index = ChainIndex(str(tmp_path / 'chain.sqlite'))
+    try:
+        index.write([
+            micro_block(1, 0, [{'tx_hash': 'tx1', 'inputs': [],
+                                'outputs': [{'utxo': 'o1', 'recipient': 'a', 'amount': 5}]}]),
+            micro_block(1, 1, [{'tx_hash': 'tx2', 'inputs': ['o1'],
+                                'outputs': [{'utxo': 'o2', 'recipient': 'b', 'amount': 4}]}]),
+        ], (1, 2))
+        assert index.find_utxo('o1')[-1] == 'tx2'
+        index.write([{'type': 'micro_block_reverted', 'epoch': 1, 'offset': 1}], (1, 1))
+        assert index.find_tx('tx2') is None
+        assert index.find_utxo('o2') is None
+        # Output spent by the reverted transaction is unspent again
+        assert index.find_utxo('o1')[-1] is None
+        assert index.find_tx('tx1') is not None
+        assert index.checkpoint() == (1, 1)
+    finally:
+        index.close()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+import asyncio
+import time
+
+from collections import OrderedDict
+
+ACCEPTED = 'accepted'
+SUCCESS = frozenset(['prepared', 'committed'])
+FAILURE = frozenset(['rejected', 'conflicted', 'rollback'])
+
+# How many finished (or not yet claimed) transactions to remember, so late
+# waiters and late status updates (e.g. committed after prepared) still match.
+RECENT_SIZE = 10_000
+
+
+class TrackedTx:
+    def __init__(self, tx_hash, account_id=None):
+        """ State of one transaction
+        Attributes:
+            tx_hash (String): transaction hash
+            account_id (String): sender account, if known
+            status (String): last reported status, None until the first one
+            timestamps: map status(String) -> time.monotonic() of transition
+            future: resolved with the first final status
+        """
+        self.tx_hash = tx_hash
+        self.account_id = account_id
+        self.status = None
+        self.created = time.monotonic()
+        self.created_at = time.time()
+        self.timestamps = {}
+        self.future = None
+
+    def update(self, status):
+        self.status = status
+        self.timestamps.setdefault(status, time.monotonic())
+        if self.future is not None and not self.future.done() and status != ACCEPTED:
+            self.future.set_result(status)
+
+    def latency(self, status, since=None):
+        """ Seconds from `since` status (creation if None) to `status` """
+        end = self.timestamps.get(status)
+        start = self.created if since is None else self.timestamps.get(since)
+        if end is None or start is None:
+            return None
+        return end - start
+
+
+class TxTracker:
+    def __init__(self, recent_size=RECENT_SIZE):
+        """ Index of transactions by tx_hash, fed by transaction_status
+        Every notification is resolved with a single dict lookup, no matter
+        how many transactions are outstanding.
+        """
+        self.pending = {}
+        self.recent = OrderedDict()
+        self.recent_size = recent_size
+
+    def __len__(self):
+        return len(self.pending)
+
+    def get(self, tx_hash):
+        return self.pending.get(tx_hash) or self.recent.get(tx_hash)
+
+    def track(self, tx_hash, account_id=None):
+        """ Start tracking tx_hash, picking up any status already received """
+        tx = self.pending.get(tx_hash)
+        if tx is None:
+            tx = self.recent.pop(tx_hash, None) or TrackedTx(tx_hash)
+            if tx.status in SUCCESS or tx.status in FAILURE:
+                self.remember(tx)
+            else:
+                self.pending[tx_hash] = tx
+        if account_id is not None:
+            tx.account_id = account_id
+        return tx
+
+    def update(self, tx_hash, status):
+        """ Apply one status of tx_hash (transaction_status or history) """
+        tx = self.pending.get(tx_hash)
+        if tx is None:
+            tx = self.recent.get(tx_hash)
+            if tx is None:
+                tx = TrackedTx(tx_hash)
+                self.remember(tx)
+        tx.update(status)
+        if tx.status in SUCCESS or tx.status in FAILURE:
+            if self.pending.pop(tx_hash, None) is not None:
+                self.remember(tx)
+        return tx
+
+    def remember(self, tx):
+        self.recent[tx.tx_hash] = tx
+        if len(self.recent) > self.recent_size:
+            self.recent.popitem(last=False)
+
+    async def wait(self, tx_hash, timeout=None):
+        """ Wait for the first final status of tx_hash
+        Raises asyncio.TimeoutError if nothing final arrives within timeout,
+        the transaction stays tracked so a later status is still recorded.
+        """
+        tx = self.get(tx_hash) or self.track(tx_hash)
+        if tx.status is not None and tx.status != ACCEPTED:
+            return tx.status
+        if tx.future is None or tx.future.done():
+            tx.future = asyncio.get_event_loop().create_future()
+        return await asyncio.wait_for(asyncio.shield(tx.future), timeout)
+
+    def cancel(self, tx_hash):
+        """ Stop tracking tx_hash and cancel its waiters """
+        tx = self.pending.pop(tx_hash, None) or self.recent.pop(tx_hash, None)
+        if tx is not None and tx.future is not None:
+            tx.future.cancel()
+        return tx
+
+    def fail_all(self, exc):
+        for tx in self.pending.values():
+            if tx.future is not None and not tx.future.done():
+                tx.future.set_exception(exc)
+                tx.future = None